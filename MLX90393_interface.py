@@ -1,5 +1,8 @@
 from pyCubeLib import CubeGUI
-from time import sleep
+
+MLX_ADDRESS = 0x0C
+# error bit of the status byte the sensor answers every command with
+STATUS_ERROR = 0x10
 
 
 def measure_func(cube):
@@ -7,15 +10,16 @@ def measure_func(cube):
     Simple measure func for MLX90393.
     """
     print("measure")
-    error, reply = cube.i2c_transfer(1, 1, 0x0C, [0x3F])
-    if error:
-        return error, (0, 0, 0)
-    sleep(0.3) 
-    error, reply = cube.i2c_transfer(9, 1, 0x0C, [0x4F])
+    # start a single measurement, wait for the conversion and read it
+    error, reads = (cube.i2c_transaction(MLX_ADDRESS)
+                    .read(1, [0x3F]).check_status(STATUS_ERROR)
+                    .delay(0.3)
+                    .read(9, [0x4F]).check_status(STATUS_ERROR)
+                    .run())
     if error:
         return error, (0, 0, 0)
 
-    payload_data = reply.get_payload()[1]
+    payload_data = reads[1]
     x = (payload_data[3] << 8) + payload_data[4]
     y = (payload_data[5] << 8) + payload_data[6]
     z = (payload_data[7] << 8) + payload_data[8]
@@ -32,16 +36,12 @@ def init_func(cube):
     Init MLX90393 to some sensible config
     """
     print("init")
-    error, reply = cube.i2c_transfer(3, 2, 0x0C, [0x50, 0x00])
+    error, reads = cube.i2c_transaction(MLX_ADDRESS).read(3, [0x50, 0x00]).check_status(STATUS_ERROR).run()
     if error:
         print(error)
         return False
-    first_reg = reply.get_payload()[1]
-    if (first_reg[0] & 0x10):
-        print("sensor error")
-        return False
 
-    manufacturer_data = first_reg[1]
+    manufacturer_data = reads[0][1]
 
     registers = [
         #gain 7, hallconf 0xC
@@ -52,15 +52,14 @@ def init_func(cube):
         [0x60, 0x02, 0xBE, 0x08]
     ]
 
+    # all register writes in one submission, each one answers with a status byte
+    transaction = cube.i2c_transaction(MLX_ADDRESS)
     for register in registers:
-        error, reply = cube.i2c_transfer(1, 4, 0x0C, register)
-        if error:
-            print(error)
-            return False
-        status = reply.get_payload()[1][0]
-        if (status & 0x10):
-            print("sensor error")
-            return False
+        transaction.read(1, register).check_status(STATUS_ERROR)
+    error, reads = transaction.run()
+    if error:
+        print(error)
+        return False
 
     return True
 
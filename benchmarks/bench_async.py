@@ -0,0 +1,52 @@
+"""
+Drive several fake Cubes on ptys concurrently from one event loop.
+Run from the repository root:
+    python -m benchmarks.bench_async [-c CUBES] [-n COUNT]
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from pyCubeLib.cube_async import AsyncCubeComm
+from benchmarks.bench_roundtrip import fake_cube
+
+
+async def drive(cube, count):
+    results = await asyncio.gather(*(cube.status() for _ in range(count)))
+    errors = [error for error, _ in results if error]
+    if errors:
+        raise RuntimeError(errors[0])
+
+
+async def run(args):
+    stop = threading.Event()
+    cubes = []
+    fds = []
+    for i in range(args.cubes):
+        master, slave = os.openpty()
+        fds.extend((master, slave))
+        threading.Thread(target=fake_cube, args=(master, stop), daemon=True).start()
+        cube = AsyncCubeComm(i * 1000)
+        cube.open(os.ttyname(slave))
+        cubes.append(cube)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(drive(cube, args.count) for cube in cubes))
+    elapsed = time.perf_counter() - start
+    total = args.cubes * args.count
+    print(f"{total} commands on {args.cubes} cubes: {elapsed * 1000:.1f} ms, "
+          f"{elapsed * 1e6 / total:.1f} us per command")
+
+    for cube in cubes:
+        cube.close()
+    stop.set()
+    for fd in fds:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AsyncCubeComm with many Cubes")
+    parser.add_argument('-c', '--cubes', type=int, default=4)
+    parser.add_argument('-n', '--count', type=int, default=200)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,48 @@
+"""
+Stop-and-wait against pipelined get_parameter bursts on a fake port
+that delays and reorders replies. Run from the repository root:
+    python -m benchmarks.bench_pipeline [-n COUNT] [-w WINDOW]
+"""
+import argparse
+import time
+from pyCubeLib import cube_commands
+from pyCubeLib.cube_comm import CubeComm
+from benchmarks.fake_port import ScriptedPort
+
+
+def check(results):
+    for param_id, (error, reply) in enumerate(results):
+        if error:
+            raise RuntimeError(f"parameter {param_id}: {error}")
+        if reply.get_payload() != param_id * 10:
+            raise RuntimeError(f"parameter {param_id}: mismatched reply {reply}")
+
+
+def stop_and_wait(cube, count):
+    return [cube.get_parameter(i) for i in range(count)]
+
+
+def pipelined(cube, count):
+    handles = [cube.submit(cube_commands.get_parameter(i)) for i in range(count)]
+    return [handle.result() for handle in handles]
+
+
+def main(args):
+    for name, func in (("stop-and-wait", stop_and_wait), ("pipelined", pipelined)):
+        cube = CubeComm(0, pipeline_window=args.window)
+        cube.set_serial_port(ScriptedPort(delay=args.delay, jitter=args.delay))
+        start = time.perf_counter()
+        results = func(cube, args.count)
+        elapsed = time.perf_counter() - start
+        check(results)
+        print(f"{name:>14}: {elapsed * 1000:8.1f} ms total, "
+              f"{elapsed * 1000 / args.count:6.3f} ms per command")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CubeComm pipelining")
+    parser.add_argument('-n', '--count', type=int, default=200)
+    parser.add_argument('-w', '--window', type=int, default=8)
+    parser.add_argument('-d', '--delay', type=float, default=0.002,
+           help="Reply delay of the fake port in seconds, also used as jitter.")
+    main(parser.parse_args())
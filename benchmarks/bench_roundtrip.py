@@ -0,0 +1,88 @@
+"""
+Round trip latency of CubeComm commands against a fake Cube on a pty.
+
+Compares the old timeout bound read(300) reply path with the
+length aware one. Run from the repository root:
+    python -m benchmarks.bench_roundtrip [-n COUNT]
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+import serial
+from pyCubeLib import cube_pb2
+from pyCubeLib.cube_comm import CubeComm
+
+
+def fake_cube(master_fd, stop):
+    """Answer every command frame with a status reply carrying the same id."""
+    buffer = bytearray()
+    while not stop.is_set():
+        try:
+            buffer += os.read(master_fd, 300)
+        except OSError:
+            return
+        while len(buffer) >= 5 and len(buffer) >= 5 + buffer[4]:
+            payload = bytes(buffer[5:5 + buffer[4]])
+            del buffer[:5 + buffer[4]]
+            cmd = cube_pb2.command_msg().FromString(payload)
+            reply = cube_pb2.reply_msg()
+            reply.id = cmd.id
+            reply.stat.pos.a = 1.0
+            data = reply.SerializeToString()
+            os.write(master_fd, bytes([0x55, 0x55, 0x55, 0x02, len(data)]) + data)
+
+
+def legacy_status(port, msg_id):
+    """The reply path as it was: one read(300) bounded by the port timeout."""
+    msg = cube_pb2.command_msg()
+    msg.id = msg_id
+    msg.inst = cube_pb2.status_i
+    data = msg.SerializeToString()
+    port.write(bytes([0x55, 0x55, 0x55, 0x01, len(data)]) + data)
+    receive = []
+    while len(receive) == 0:
+        receive = port.read(300)
+    return receive
+
+
+def measure(func, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    print(f"{name:>10}: mean {statistics.mean(times) * 1000:8.3f} ms, "
+          f"median {statistics.median(times) * 1000:8.3f} ms, "
+          f"max {max(times) * 1000:8.3f} ms")
+
+
+def main(args):
+    master, slave = os.openpty()
+    stop = threading.Event()
+    thread = threading.Thread(target=fake_cube, args=(master, stop), daemon=True)
+    thread.start()
+    port = serial.Serial(os.ttyname(slave), 115200, timeout=0.1)
+
+    report("read(300)", measure(lambda i: legacy_status(port, i), args.count))
+
+    cube = CubeComm(0)
+    cube.set_serial_port(port)
+    report("framed", measure(lambda i: cube.status(), args.count))
+
+    stop.set()
+    port.close()
+    os.close(slave)
+    os.close(master)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CubeComm round trip latency")
+    parser.add_argument('-n', '--count', type=int, default=50,
+           help="Number of status commands per variant.")
+    main(parser.parse_args())
@@ -0,0 +1,100 @@
+"""
+Checks the hand written reply decoder against the generated cube_pb2 code.
+Run from the repository root:
+    python -m benchmarks.conformance [-n COUNT]
+"""
+import argparse
+import math
+import random
+import struct
+import sys
+from google.protobuf.message import DecodeError
+from pyCubeLib import cube_pb2
+from pyCubeLib.cube_comm import decode_reply, decode_reply_pb
+
+
+def random_float(rng):
+    while True:
+        value = struct.unpack('<f', struct.pack('<I', rng.getrandbits(32)))[0]
+        if not math.isnan(value):
+            return value
+
+
+def random_reply(rng):
+    msg = cube_pb2.reply_msg()
+    msg.id = rng.choice((0, 1, 127, 128, 2 ** 32 - 1, rng.getrandbits(32)))
+    if rng.random() < 0.9:
+        msg.stat.error_id = rng.choice((0, 0, 0, rng.getrandbits(32)))
+        msg.stat.mode = rng.choice((0, 1, 2))
+        if rng.random() < 0.9:
+            msg.stat.pos.a = random_float(rng)
+            msg.stat.pos.b = random_float(rng)
+            msg.stat.pos.c = random_float(rng)
+    payload = rng.randrange(4)
+    if payload == 1:
+        msg.data.length = rng.randrange(256)
+        msg.data.data = bytes(rng.getrandbits(8) for _ in range(rng.randrange(80)))
+    elif payload == 2:
+        msg.gpio_status = rng.random() < 0.5
+    elif payload == 3:
+        msg.param_value = rng.getrandbits(32)
+    return msg.SerializeToString()
+
+
+def unknown_field(rng):
+    # field numbers above the schema with every wire type
+    field = rng.randrange(6, 100)
+    kind = rng.choice((0, 1, 2, 5))
+    tag = bytes([(field << 3 | kind) & 0x7F | 0x80, field >> 4])
+    if kind == 0:
+        return tag + b'\x96\x01'
+    if kind == 1:
+        return tag + bytes(8)
+    if kind == 2:
+        return tag + b'\x03abc'
+    return tag + bytes(4)
+
+
+def same(packet):
+    try:
+        expected = decode_reply_pb(packet)
+    except DecodeError:
+        try:
+            decode_reply(packet)
+        except ValueError:
+            return True
+        return False
+    return decode_reply(packet) == expected
+
+
+def check(count, seed=0):
+    """
+    Compare both decoders on count random packets, returns the failing ones.
+    """
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(count):
+        packet = random_reply(rng)
+        variant = rng.randrange(4)
+        if variant == 1:
+            # concatenated messages merge
+            packet += random_reply(rng)
+        elif variant == 2:
+            packet += unknown_field(rng)
+        elif variant == 3 and len(packet) > 1:
+            packet = packet[:rng.randrange(1, len(packet))]
+        if not same(packet):
+            failures.append(packet)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="reply_msg decoder conformance")
+    parser.add_argument('-n', '--count', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    failures = check(args.count, args.seed)
+    for packet in failures[:10]:
+        print("mismatch:", packet.hex())
+    print(f"{args.count - len(failures)}/{args.count} packets decode the same")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,83 @@
+"""
+In-process stand-in for serial.Serial that answers Cube commands.
+"""
+import heapq
+import random
+import time
+from pyCubeLib import cube_pb2
+from pyCubeLib.cube_frame import FrameDecoder, encode_frame, COMMAND_FRAME, REPLY_FRAME
+
+
+def echo_handler(cmd):
+    """Reply with the same id, parameters read back as id * 10."""
+    reply = cube_pb2.reply_msg()
+    reply.id = cmd.id
+    if cmd.inst == cube_pb2.get_parameter:
+        reply.param_value = cmd.param.id * 10
+    elif cmd.inst == cube_pb2.get_gpio:
+        reply.gpio_status = cmd.gpio.index % 2 == 1
+    elif cmd.inst == cube_pb2.i2c_transfer:
+        reply.data.length = cmd.i2c.rx_length
+        reply.data.data = bytes(cmd.i2c.rx_length)
+    elif cmd.inst == cube_pb2.spi_transfer:
+        reply.data.length = cmd.spi.length
+        reply.data.data = bytes(cmd.spi.length)
+    return reply
+
+
+class ScriptedPort:
+    """
+    Every command frame written is answered after delay seconds plus
+    a random jitter, so with jitter larger than the command spacing the
+    replies come back reordered.
+    """
+    def __init__(self, delay=0.001, jitter=0.0, timeout=0.1, seed=0, handler=echo_handler):
+        self.timeout = timeout
+        self.delay = delay
+        self.jitter = jitter
+        self.handler = handler
+        self.written = 0
+        self.__random = random.Random(seed)
+        self.__decoder = FrameDecoder(frame_types=(COMMAND_FRAME,))
+        self.__queue = []
+        self.__count = 0
+        self.__buffer = bytearray()
+
+    def __release(self, now):
+        while len(self.__queue) > 0 and self.__queue[0][0] <= now:
+            self.__buffer += heapq.heappop(self.__queue)[2]
+
+    @property
+    def in_waiting(self):
+        self.__release(time.monotonic())
+        return len(self.__buffer)
+
+    def write(self, data):
+        now = time.monotonic()
+        self.written += len(data)
+        for _, payload in self.__decoder.feed(bytes(data)):
+            cmd = cube_pb2.command_msg().FromString(payload)
+            reply = self.handler(cmd).SerializeToString()
+            due = now + self.delay + self.__random.uniform(0, self.jitter)
+            self.__count += 1
+            heapq.heappush(self.__queue, (due, self.__count, encode_frame(REPLY_FRAME, reply)))
+        return len(data)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            self.__release(now)
+            if len(self.__buffer) >= size or now >= deadline:
+                break
+            next_due = self.__queue[0][0] if len(self.__queue) > 0 else deadline
+            time.sleep(max(0, min(next_due, deadline) - now))
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
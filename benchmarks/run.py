@@ -0,0 +1,342 @@
+"""
+Benchmark suite for the comm, scan and visualization hot paths.
+
+Results are written as JSON and can be compared against a previous run
+or the committed baseline. Run from the repository root:
+    python -m benchmarks.run [--quick] [--output FILE] [--compare benchmarks/baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import serial
+from pyCubeLib import cube_pb2
+from pyCubeLib import cube_commands
+from pyCubeLib.cube_comm import CubeComm, decode_reply, decode_reply_pb
+from pyCubeLib.cube_replies import ReplyBatch
+from pyCubeLib.cube_frame import FrameDecoder, encode_frame, REPLY_FRAME
+from pyCubeLib.cube_plan import ScanPlan
+from pyCubeLib.cube_scan import GridScan
+from pyCubeLib.cube_sim import CubeSimulator, PtyCubeServer
+import vis_launch
+from benchmarks import conformance
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+# a result is a regression when it is this much worse than the reference
+TOLERANCE = 0.25
+
+
+def best_of(func, repeat):
+    """
+    Run func repeat times, returns the fastest wall time in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def result(value, unit, better="lower"):
+    return {"value": value, "unit": unit, "better": better}
+
+
+def sample_reply():
+    reply = cube_pb2.reply_msg()
+    reply.id = 1234
+    reply.stat.pos.a = 12.5
+    reply.stat.pos.b = -3.25
+    reply.stat.pos.c = 100.0
+    reply.data.length = 9
+    reply.data.data = bytes(range(9))
+    return reply.SerializeToString()
+
+
+def bench_codec(args):
+    count = 20000 if args.quick else 100000
+    encode = best_of(lambda: [cube_commands.move_to(1.0, 2.0, 3.0).SerializeToString()
+                              for _ in range(count)], args.repeat)
+    if conformance.check(2000):
+        raise RuntimeError("decode_reply does not match cube_pb2, run benchmarks.conformance")
+    packet = sample_reply()
+    parse = best_of(lambda: [cube_pb2.reply_msg().FromString(packet) for _ in range(count)], args.repeat)
+    decode_pb = best_of(lambda: [decode_reply_pb(packet) for _ in range(count)], args.repeat)
+    decode = best_of(lambda: [decode_reply(packet) for _ in range(count)], args.repeat)
+    decode_data = best_of(lambda: [decode_reply(packet).payload_data for _ in range(count)], args.repeat)
+    return {
+        "codec.encode_move_to": result(encode / count * 1e6, "us"),
+        "codec.parse_reply_msg": result(parse / count * 1e6, "us"),
+        "codec.decode_reply_pb": result(decode_pb / count * 1e6, "us"),
+        "codec.decode_reply": result(decode / count * 1e6, "us"),
+        "codec.decode_reply_with_data": result(decode_data / count * 1e6, "us"),
+    }
+
+
+def bench_memory(args):
+    count = 20000 if args.quick else 200000
+    packet = sample_reply()
+
+    def measure(build):
+        tracemalloc.start()
+        kept = build()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return used / count
+
+    def replies():
+        kept = []
+        for _ in range(count):
+            reply = decode_reply(packet)
+            reply.payload_data
+            kept.append(reply)
+        return kept
+
+    def batch():
+        kept = ReplyBatch(count)
+        for _ in range(count):
+            kept.append(decode_reply(packet))
+        return kept
+
+    return {
+        "memory.reply_list": result(measure(replies), "B/reply"),
+        "memory.reply_batch": result(measure(batch), "B/reply"),
+    }
+
+
+def legacy_frame(msg):
+    # how CubeComm built frames before the CommandEncoder
+    data = msg.SerializeToString()
+    msg_out = [0x55, 0x55, 0x55, 0x01, len(data)]
+    msg_out.extend(data)
+    return bytes(msg_out)
+
+
+def bench_encode(args):
+    count = 20000 if args.quick else 100000
+    encoder = cube_commands.CommandEncoder()
+
+    def legacy_status():
+        for i in range(count):
+            msg = cube_commands.status()
+            msg.id = i
+            legacy_frame(msg)
+
+    def template_status():
+        for i in range(count):
+            bytes(encoder.encode_simple(i, cube_pb2.status_i))
+
+    def legacy_move_to():
+        for i in range(count):
+            msg = cube_commands.move_to(1.0, 2.0, 3.0)
+            msg.id = i
+            legacy_frame(msg)
+
+    def reused_move_to():
+        for i in range(count):
+            msg = cube_commands.move_to(1.0, 2.0, 3.0, msg=encoder.message(cube_pb2.move_to))
+            msg.id = i
+            bytes(encoder.encode(msg))
+
+    results = {}
+    for name, func in (("legacy_status", legacy_status), ("template_status", template_status),
+                       ("legacy_move_to", legacy_move_to), ("reused_move_to", reused_move_to)):
+        results[f"encode.{name}"] = result(best_of(func, args.repeat) / count * 1e6, "us")
+    # wire size of the MLX90393 start measurement command
+    frame = encoder.encode(cube_commands.i2c_transfer(1, 1, 0x0C, [0x3F], msg=encoder.message(cube_pb2.i2c_transfer)))
+    results["encode.i2c_frame_bytes"] = result(len(frame), "B")
+    return results
+
+
+def bench_decoder(args):
+    frame = encode_frame(REPLY_FRAME, sample_reply())
+    stream = frame * (2000 if args.quick else 20000)
+    results = {}
+    for chunk in (1, 64, 4096):
+        if chunk == 1 and not args.quick:
+            data = stream[:len(stream) // 10]
+        else:
+            data = stream
+        chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+
+        def run():
+            decoder = FrameDecoder()
+            for item in chunks:
+                decoder.feed(item)
+        elapsed = best_of(run, args.repeat)
+        results[f"decoder.chunk_{chunk}"] = result(len(data) / elapsed / 1e6, "MB/s", "higher")
+    return results
+
+
+def connect_sim(simulator, **kwargs):
+    server = PtyCubeServer(simulator, **kwargs)
+    port = serial.Serial(server.start(), 115200, timeout=0.1)
+    cube = CubeComm(0)
+    cube.set_serial_port(port)
+    return server, port, cube
+
+
+def disconnect_sim(server, port, cube):
+    cube.set_serial_port(None)
+    port.close()
+    server.stop()
+
+
+def bench_roundtrip(args):
+    count = 200 if args.quick else 1000
+    server, port, cube = connect_sim(CubeSimulator(latency={}, speed=0), baudrate=None)
+    results = {}
+    for name, func in (("status", cube.status),
+                       ("get_parameter", lambda: cube.get_parameter(1)),
+                       ("i2c_transfer", lambda: cube.i2c_transfer(9, 1, 0x0C, [0x4F]))):
+        times = []
+        for _ in range(count):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        results[f"roundtrip.{name}.median"] = result(statistics.median(times) * 1e3, "ms")
+        results[f"roundtrip.{name}.p99"] = result(sorted(times)[int(len(times) * 0.99)] * 1e3, "ms")
+    disconnect_sim(server, port, cube)
+    return results
+
+
+def bench_batch(args):
+    count = 20 if args.quick else 100
+    server, port, cube = connect_sim(CubeSimulator(latency={}, speed=0), baudrate=115200)
+    commands = [cube_commands.set_parameter(i, i) for i in range(12)]
+
+    def sequential():
+        for msg in commands:
+            cube.set_parameter(msg.param.id, msg.param.value)
+
+    results = {}
+    for name, func in (("sequential", sequential),
+                       ("pipelined", lambda: cube.send_batch(commands)),
+                       ("frames", lambda: cube.send_batch(commands))):
+        cube.set_batch_frames(name == "frames")
+        results[f"batch.{name}"] = result(best_of(func, count) * 1e3, "ms")
+    disconnect_sim(server, port, cube)
+    return results
+
+
+def fake_measure(cube):
+    error, reply = cube.i2c_transfer(1, 1, 0x0C, [0x3F])
+    if error:
+        return error, (0, 0, 0)
+    error, reply = cube.i2c_transfer(9, 1, 0x0C, [0x4F])
+    if error:
+        return error, (0, 0, 0)
+    data = reply.get_payload()[1]
+    return None, ((data[3] << 8) + data[4], (data[5] << 8) + data[6], (data[7] << 8) + data[8])
+
+
+def bench_scan(args):
+    count = (5, 5, 2) if args.quick else (10, 10, 5)
+    points = count[0] * count[1] * count[2]
+    server, port, cube = connect_sim(CubeSimulator(speed=0), baudrate=None)
+    with tempfile.TemporaryDirectory() as tmp:
+        scan = GridScan(cube, fake_measure, ScanPlan((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), count),
+                        os.path.join(tmp, "scan.csv"))
+        elapsed = best_of(scan.run, 1)
+    disconnect_sim(server, port, cube)
+    return {
+        "scan.per_point": result(elapsed / points * 1e3, "ms"),
+    }
+
+
+def write_scan_file(path, steps):
+    count = steps[0] * steps[1] * steps[2]
+    values = np.random.default_rng(0).normal(size=(count, 6))
+    with open(path, "w") as out:
+        out.write("2021-01-01\n")
+        out.write(repr({"steps": list(steps)}) + "\n")
+        out.write("x_pos, y_pos, z_pos, x_val, y_val, z_val\n")
+        np.savetxt(out, values, delimiter=", ", fmt="%.6f")
+
+
+def bench_load(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            side = round(size ** (1 / 3))
+            steps = (side, side, size // (side * side))
+            path = os.path.join(tmp, f"scan_{size}.csv")
+            write_scan_file(path, steps)
+            elapsed = best_of(lambda: vis_launch.load_data(path), 1)
+            results[f"load_data.{size}"] = result(elapsed, "s")
+    return results
+
+
+SUITES = {
+    "codec": bench_codec,
+    "encode": bench_encode,
+    "memory": bench_memory,
+    "decoder": bench_decoder,
+    "roundtrip": bench_roundtrip,
+    "batch": bench_batch,
+    "scan": bench_scan,
+    "load": bench_load,
+}
+
+
+def compare(results, reference):
+    regressions = 0
+    print(f"{'benchmark':<36}{'value':>12}{'reference':>12}{'ratio':>8}")
+    for name, item in results.items():
+        ref = reference.get(name)
+        if ref is None:
+            print(f"{name:<36}{item['value']:>12.4g}{'-':>12}")
+            continue
+        ratio = item["value"] / ref["value"] if ref["value"] else float("inf")
+        worse = ratio > 1 + TOLERANCE if item["better"] == "lower" else ratio < 1 / (1 + TOLERANCE)
+        regressions += worse
+        flag = "  REGRESSION" if worse else ""
+        print(f"{name:<36}{item['value']:>12.4g}{ref['value']:>12.4g}{ratio:>8.2f}{flag}")
+    return regressions
+
+
+def main(args):
+    results = {}
+    for name in args.suite or SUITES:
+        results.update(SUITES[name](args))
+    report = {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "quick": args.quick,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+            out.write("\n")
+    if args.compare:
+        with open(args.compare) as ref_file:
+            reference = json.load(ref_file)["results"]
+        return 1 if compare(results, reference) > 0 else 0
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cube software benchmark suite")
+    parser.add_argument('--suite', action='append', choices=list(SUITES),
+           help="Run only this suite, can be repeated.")
+    parser.add_argument('--quick', action='store_true',
+           help="Smaller workloads, used for the committed baseline.")
+    parser.add_argument('--repeat', type=int, default=3,
+           help="Repetitions of the micro benchmarks, the best one is reported.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6],
+           help="Point counts of the files for load_data, e.g. 10000 10000000.")
+    parser.add_argument('--output', metavar='FILE', help="Write the JSON report to FILE.")
+    parser.add_argument('--compare', metavar='FILE', nargs='?', const=BASELINE,
+           help="Compare against a previous report, defaults to the committed baseline.")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,88 @@
+"""
+Checks CubeComm against the simulator for command sequences that went
+wrong before. Run from the repository root:
+    python -m benchmarks.sim_checks [NAME ...]
+"""
+import argparse
+import sys
+import serial
+from pyCubeLib.cube_comm import CubeComm
+from pyCubeLib.cube_commands import TRANSFER_CHUNK
+from pyCubeLib.cube_sim import CubeSimulator, PtyCubeServer, EEPROM_ADDRESS
+
+
+class SimCube:
+    """
+    CubeComm connected to an instant simulator on a pty.
+    """
+    def __init__(self, **kwargs):
+        self.simulator = CubeSimulator(latency={}, speed=0, **kwargs)
+        self.server = PtyCubeServer(self.simulator)
+        self.port = serial.Serial(self.server.start(), 115200, timeout=0.1)
+        self.cube = CubeComm(1)
+        self.cube.set_serial_port(self.port)
+
+    def __enter__(self):
+        return self.cube
+
+    def __exit__(self, *exc):
+        self.cube.set_serial_port(None)
+        self.port.close()
+        self.server.stop()
+
+
+def check_skip_after_absolute_pos():
+    # the absolute position of a get_abs_pos reply must not count as the
+    # relative one, the second move has to be sent
+    with SimCube() as cube:
+        cube.set_skip_moves()
+        cube.move_to(10, 10, 10)
+        cube.set_zero()
+        cube.absolute_pos()
+        error, reply = cube.move_to(10, 10, 10)
+        if error or reply.id == 0:
+            return f"move after absolute_pos was skipped: {error or 'cached reply'}"
+    return None
+
+
+def check_eeprom_long_read():
+    # one write of the address, the read continues over several transfers
+    data = bytes(range(TRANSFER_CHUNK - 2))
+    with SimCube() as cube:
+        error, _ = cube.i2c_transfer(0, len(data) + 2, EEPROM_ADDRESS, [0x01, 0x00] + list(data))
+        if error:
+            return f"write failed: {error}"
+        error, reply = cube.i2c_transfer(3 * TRANSFER_CHUNK, 2, EEPROM_ADDRESS, [0x01, 0x00])
+        if error:
+            return f"read failed: {error}"
+        if reply.payload_data[1][:len(data)] != data:
+            return "read back wrong data"
+    return None
+
+
+def check_eeprom_long_write():
+    # a write that would have to be split is refused instead of corrupting
+    with SimCube() as cube:
+        error, _ = cube.i2c_transfer(0, 102, EEPROM_ADDRESS, [0x01, 0x00] + [0xAA] * 100)
+        if error is None:
+            return "102 byte write was not refused"
+    return None
+
+
+CHECKS = {
+    "skip_after_absolute_pos": check_skip_after_absolute_pos,
+    "eeprom_long_read": check_eeprom_long_read,
+    "eeprom_long_write": check_eeprom_long_write,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CubeComm checks against the simulator")
+    parser.add_argument('names', nargs='*', help="Checks to run, all by default.")
+    args = parser.parse_args()
+    failed = 0
+    for name in args.names or CHECKS:
+        failure = CHECKS[name]()
+        print(f"{name}: {failure or 'ok'}")
+        failed += failure is not None
+    sys.exit(1 if failed else 0)
@@ -1,2 +1,3 @@
 from pyCubeLib.cube_comm import CubeComm
-from pyCubeLib.gui import CubeGUI
\ No newline at end of file
+from pyCubeLib.cube_async import AsyncCubeComm
+from pyCubeLib.gui import CubeGUI
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import serial
+from pyCubeLib import cube_pb2
+from pyCubeLib import cube_commands
+from pyCubeLib.cube_comm import check_frame, decode_reply, DEFAULT_REPLY_TIMEOUT, LONG_REPLY_TIMEOUT, DEFAULT_PIPELINE_WINDOW
+from pyCubeLib.cube_frame import FrameDecoder, encode_frame, COMMAND_FRAME
+
+
+class AsyncCubeComm:
+    """
+    Asyncio counterpart of CubeComm.
+
+    The port is a non-blocking file descriptor watched by the event loop,
+    so any number of Cubes can be driven from one thread. All commands
+    are coroutines returning the same (error, reply) tuple as CubeComm.
+    """
+    def __init__(self, id_start, reply_timeout=DEFAULT_REPLY_TIMEOUT,
+                 pipeline_window=DEFAULT_PIPELINE_WINDOW):
+        self.id = id_start
+        self.__reply_timeout = reply_timeout
+        self.__inst_timeouts = {
+            cube_pb2.move_to: LONG_REPLY_TIMEOUT,
+            cube_pb2.home: LONG_REPLY_TIMEOUT,
+        }
+        self.__window = asyncio.Semaphore(pipeline_window)
+        self.__loop = None
+        self.__port = None
+        self.__fd = None
+        self.__decoder = FrameDecoder()
+        self.__out = bytearray()
+        # futures of in flight commands by id, in the order they were sent
+        self.__pending = {}
+
+    def __get_id(self):
+        self.id += 1
+        return self.id
+
+    def __get_timeout(self, inst):
+        return self.__inst_timeouts.get(inst, self.__reply_timeout)
+
+    def __on_readable(self):
+        try:
+            data = os.read(self.__fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            self.__fail_pending(f"cube_comm: port error {err.errno}")
+            self.__loop.remove_reader(self.__fd)
+            return
+        for frame in self.__decoder.feed(data):
+            self.__dispatch(frame)
+
+    def __on_writable(self):
+        self.__flush()
+
+    def __flush(self):
+        try:
+            written = os.write(self.__fd, self.__out)
+        except BlockingIOError:
+            written = 0
+        del self.__out[:written]
+        if len(self.__out) > 0:
+            self.__loop.add_writer(self.__fd, self.__on_writable)
+        else:
+            self.__loop.remove_writer(self.__fd)
+
+    def __dispatch(self, frame):
+        error, packet = check_frame(frame)
+        if not error:
+            try:
+                reply = decode_reply(packet)
+            except ValueError:
+                error = "cube_comm: bad reply"
+        if error:
+            # a broken frame can not be matched by id, the Cube answers
+            # in order so it belongs to the oldest command in flight
+            for future in self.__pending.values():
+                if not future.done():
+                    future.set_result((error, None))
+                    break
+            return
+        future = self.__pending.get(reply.id)
+        if future is not None and not future.done():
+            future.set_result((None, reply))
+
+    def __fail_pending(self, error):
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_result((error, None))
+
+    def attach_fd(self, fd):
+        """
+        Use an already open and configured file descriptor (a pty or tty)
+        as the port. It is switched to non-blocking mode.
+        """
+        self.close()
+        self.__loop = asyncio.get_running_loop()
+        self.__fd = fd
+        os.set_blocking(fd, False)
+        self.__decoder.reset()
+        self.__loop.add_reader(fd, self.__on_readable)
+
+    def open(self, path, baudrate=115200):
+        """
+        Open and configure a serial port, must be called from the event loop.
+        """
+        port = serial.Serial(path, baudrate, timeout=0)
+        self.attach_fd(port.fileno())
+        self.__port = port
+
+    def close(self):
+        if self.__fd is None:
+            return
+        self.__loop.remove_reader(self.__fd)
+        self.__loop.remove_writer(self.__fd)
+        self.__fail_pending("cube_comm: port closed")
+        self.__out.clear()
+        if self.__port is not None:
+            self.__port.close()
+            self.__port = None
+        self.__fd = None
+
+    async def send(self, msg):
+        """
+        Send a command and wait for its reply, commands from concurrent
+        tasks are pipelined up to the window size.
+        """
+        if self.__fd is None:
+            return ("cube_comm: not connected", None)
+        async with self.__window:
+            msg.id = self.__get_id()
+            future = self.__loop.create_future()
+            self.__pending[msg.id] = future
+            self.__out += encode_frame(COMMAND_FRAME, msg.SerializeToString())
+            self.__flush()
+            try:
+                return await asyncio.wait_for(future, self.__get_timeout(msg.inst))
+            except asyncio.TimeoutError:
+                if len(self.__decoder) > 0:
+                    # the frame never completes, the next reply would be
+                    # taken as its rest
+                    self.__decoder.resync()
+                    return ("cube_comm: lost data", None)
+                return ("cube_comm: no reply", None)
+            finally:
+                del self.__pending[msg.id]
+
+    def set_reply_timeout(self, timeout, inst=None):
+        """
+        Set how long to wait for a reply, in seconds.
+        If inst is given, the timeout only applies to that instruction.
+        """
+        if inst is None:
+            self.__reply_timeout = timeout
+        else:
+            self.__inst_timeouts[inst] = timeout
+
+    async def status(self):
+        return await self.send(cube_commands.status())
+
+    async def absolute_pos(self):
+        return await self.send(cube_commands.absolute_pos())
+
+    async def relative_pos(self):
+        return await self.send(cube_commands.relative_pos())
+
+    async def set_zero(self):
+        return await self.send(cube_commands.set_zero())
+
+    async def reset_zero(self):
+        return await self.send(cube_commands.reset_zero())
+
+    async def home(self):
+        return await self.send(cube_commands.home())
+
+    async def move_to(self, a, b, c):
+        return await self.send(cube_commands.move_to(a, b, c))
+
+    async def set_coordinate_mode(self, mode):
+        return await self.send(cube_commands.set_coordinate_mode(mode))
+
+    async def spi_transfer(self, cs, mode, length, data):
+        return await self.send(cube_commands.spi_transfer(cs, mode, length, data))
+
+    async def i2c_transfer(self, rx_len, tx_len, addr, data):
+        return await self.send(cube_commands.i2c_transfer(rx_len, tx_len, addr, data))
+
+    async def set_gpio_mode(self, index, mode):
+        return await self.send(cube_commands.set_gpio_mode(index, mode))
+
+    async def set_gpio(self, index, value):
+        return await self.send(cube_commands.set_gpio(index, value))
+
+    async def get_gpio(self, index):
+        return await self.send(cube_commands.get_gpio(index))
+
+    async def set_parameter(self, id, value):
+        return await self.send(cube_commands.set_parameter(id, value))
+
+    async def get_parameter(self, id):
+        return await self.send(cube_commands.get_parameter(id))
@@ -1,214 +1,1092 @@
+import json
+import os
+import struct
+import threading
+import time
 import typing
-from dataclasses import dataclass
+import numpy as np
 from pyCubeLib import cube_pb2
+from pyCubeLib import cube_commands
+from pyCubeLib.cube_stats import CommStats
+from pyCubeLib.cube_i2c import I2CTransaction
+from pyCubeLib.cube_journal import CubeJournal, RECORD_IN, RECORD_OUT
+from pyCubeLib.cube_state import CubeState, MOVE_INSTRUCTIONS
+from pyCubeLib.cube_frame import FrameDecoder, encode_frame, pack_batch, frame_kind, REPLY_FRAME, COMMAND_FRAME, \
+    BATCH_COMMAND_FRAME, BATCH_ABORT_ON_ERROR, FRAME_MAX_PAYLOAD, CRC_FLAG, CRC_LENGTH, EXTENDED_FLAG
+
+# seconds to wait for a reply, moves and homing can take a long time
+DEFAULT_REPLY_TIMEOUT = 1.0
+LONG_REPLY_TIMEOUT = 60.0
+
+DEFAULT_PIPELINE_WINDOW = 8
+
+# seconds before the first retry, doubled for every further one
+DEFAULT_RETRY_BACKOFF = 0.05
+
+# instructions that give the same result when the Cube executes them twice,
+# so they can be sent again when their reply is lost
+IDEMPOTENT_INSTRUCTIONS = frozenset((
+    cube_pb2.status_i,
+    cube_pb2.get_abs_pos,
+    cube_pb2.get_rel_pos,
+    cube_pb2.set_zero_pos,
+    cube_pb2.reset_zero_pos,
+    cube_pb2.home,
+    cube_pb2.move_to,
+    cube_pb2.set_coordinate_mode,
+    cube_pb2.set_gpio_mode,
+    cube_pb2.set_gpio,
+    cube_pb2.get_gpio,
+    cube_pb2.set_parameter,
+    cube_pb2.get_parameter,
+))
+
+# errors of the link rather than the command, worth a retry
+RETRY_ERRORS = frozenset((
+    "cube_comm: no reply",
+    "cube_comm: lost data",
+    "cube_comm: bad reply",
+    "cube_comm: wrong reply",
+    "cube_comm: no data",
+    "cube_comm: crc error",
+))
 
 
-@dataclass
 class Reply:
-    id: int
-    error: int
-    mode: int
-    position: typing.Tuple[float, float, float]
-    payload_gpio: typing.Optional[bool] = None
-    payload_parameter: typing.Optional[int] = None
-    payload_data: typing.Optional[tuple[int, list[int]]] = None
+    """
+    Decoded reply_msg. The data payload can be kept as a slice of the
+    received packet and is only copied out when payload_data is read.
+    Slotted, so long sessions can keep many of them around.
+    """
+    __slots__ = ('id', 'error', 'mode', 'position', 'payload_gpio',
+                 'payload_parameter', '__payload_data', '__raw_data')
+
+    def __init__(self, id, error, mode, position, payload_gpio=None,
+                 payload_parameter=None, payload_data=None):
+        self.id = id
+        self.error = error
+        self.mode = mode
+        self.position = position
+        self.payload_gpio = payload_gpio
+        self.payload_parameter = payload_parameter
+        self.__payload_data = payload_data
+        self.__raw_data = None
+
+    def set_raw_data(self, view):
+        """
+        Keep a serialized data_reply_submsg to be decoded on access.
+        """
+        self.__raw_data = view
+        self.__payload_data = None
+
+    @property
+    def payload_data(self) -> typing.Optional[tuple[int, bytes]]:
+        if self.__raw_data is not None:
+            self.__payload_data = decode_data_submsg(self.__raw_data)
+            self.__raw_data = None
+        return self.__payload_data
+
+    @payload_data.setter
+    def payload_data(self, value):
+        self.__raw_data = None
+        self.__payload_data = value
+
+    def has_data(self):
+        return self.__raw_data is not None or self.__payload_data is not None
 
     def get_payload(self):
         if self.payload_gpio is not None:
             return self.payload_gpio
         if self.payload_parameter is not None:
             return self.payload_parameter
-        if self.payload_data is not None:
+        if self.has_data():
             return self.payload_data
         return None
 
+    def __fields(self):
+        return (self.id, self.error, self.mode, self.position, self.payload_gpio,
+                self.payload_parameter, self.payload_data)
+
+    def __eq__(self, other):
+        if not isinstance(other, Reply):
+            return NotImplemented
+        return self.__fields() == other.__fields()
+
+    def __repr__(self):
+        return (f"Reply(id={self.id!r}, error={self.error!r}, mode={self.mode!r}, "
+                f"position={self.position!r}, payload_gpio={self.payload_gpio!r}, "
+                f"payload_parameter={self.payload_parameter!r}, payload_data={self.payload_data!r})")
+
+
+def write_parameter_file(path, parameters):
+    """
+    Save a {id: value} snapshot of parameters as JSON.
+    """
+    with open(path, "w") as out:
+        json.dump({"saved": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "parameters": {str(id): value for id, value in sorted(parameters.items())}},
+                  out, indent=2)
+        out.write("\n")
+
+
+def read_parameter_file(path):
+    """
+    Load a snapshot saved by write_parameter_file, returns {id: value}.
+    """
+    with open(path) as in_file:
+        snapshot = json.load(in_file)
+    return {int(id): int(value) for id, value in snapshot["parameters"].items()}
+
+
+def check_frame(frame):
+    """
+    Check a (type, payload) frame from the decoder, returns (error, payload).
+    """
+    msg_type, packet = frame
+    if frame_kind(msg_type) != REPLY_FRAME:
+        return ("cube_comm: wrong reply", None)
+    if packet is None:
+        return ("cube_comm: crc error", None)
+    if len(packet) == 0:
+        return ("cube_comm: no data", None)
+    return (None, packet)
+
+
+def decode_reply_pb(packet):
+    """
+    Decode a serialized reply_msg with the generated protobuf code.
+    Reference for decode_reply.
+    """
+    msg = cube_pb2.reply_msg().FromString(packet)
+    position = (msg.stat.pos.a, msg.stat.pos.b, msg.stat.pos.c)
+    reply = Reply(int(msg.id), int(msg.stat.error_id), int(msg.stat.mode), position)
+    if msg.HasField('data'):
+        reply.payload_data = (msg.data.length, msg.data.data)
+    elif msg.HasField('gpio_status'):
+        reply.payload_gpio = msg.gpio_status
+    elif msg.HasField('param_value'):
+        reply.payload_parameter = msg.param_value
+    return reply
+
+
+# Hand written decoder for the small reply_msg schema, it works directly on
+# a memoryview of the packet. Keep in sync with cube.proto, the conformance
+# check in benchmarks/conformance.py compares it to decode_reply_pb.
+
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LEN = 2
+_WIRE_FIXED32 = 5
+_UINT32_MASK = 0xFFFFFFFF
+_unpack_float = struct.Struct('<f').unpack_from
+
+
+def _read_varint(view, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_len(view, pos):
+    length, pos = _read_varint(view, pos)
+    end = pos + length
+    if end > len(view):
+        raise IndexError("length past the end")
+    return pos, end
+
+
+def _skip(view, pos, wire_type):
+    if wire_type == _WIRE_VARINT:
+        return _read_varint(view, pos)[1]
+    if wire_type == _WIRE_FIXED64:
+        return pos + 8
+    if wire_type == _WIRE_LEN:
+        return _read_len(view, pos)[1]
+    if wire_type == _WIRE_FIXED32:
+        return pos + 4
+    raise ValueError(f"unsupported wire type {wire_type}")
+
+
+def _to_enum(value):
+    # enums are int32, negative values come sign extended to 64 bits
+    value &= _UINT32_MASK
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def _decode_position(view, pos, end, position):
+    while pos < end:
+        tag, pos = _read_varint(view, pos)
+        field = tag >> 3
+        if tag & 7 == _WIRE_FIXED32 and 1 <= field <= 3:
+            if pos + 4 > end:
+                raise IndexError("float past the end")
+            position[field - 1] = _unpack_float(view, pos)[0]
+            pos += 4
+        else:
+            pos = _skip(view, pos, tag & 7)
+    if pos != end:
+        raise IndexError("field past the end")
+
+
+def _decode_status(view, pos, end, status):
+    while pos < end:
+        tag, pos = _read_varint(view, pos)
+        if tag == 0x08:
+            value, pos = _read_varint(view, pos)
+            status[0] = value & _UINT32_MASK
+        elif tag == 0x10:
+            value, pos = _read_varint(view, pos)
+            status[1] = _to_enum(value)
+        elif tag == 0x1A:
+            start, pos = _read_len(view, pos)
+            _decode_position(view, start, pos, status[2])
+        else:
+            pos = _skip(view, pos, tag & 7)
+    if pos != end:
+        raise IndexError("field past the end")
+
+
+def decode_data_submsg(view):
+    """
+    Decode a serialized data_reply_submsg into (length, data).
+    """
+    length = 0
+    data = b''
+    pos = 0
+    end = len(view)
+    try:
+        while pos < end:
+            tag, pos = _read_varint(view, pos)
+            if tag == 0x08:
+                value, pos = _read_varint(view, pos)
+                length = value & _UINT32_MASK
+            elif tag == 0x12:
+                start, pos = _read_len(view, pos)
+                data = bytes(view[start:pos])
+            else:
+                pos = _skip(view, pos, tag & 7)
+    except IndexError as err:
+        raise ValueError("truncated data_reply_submsg") from err
+    return (length, data)
+
+
+def decode_reply(packet):
+    """
+    Decode a serialized reply_msg into a Reply.
+    id, error, mode and position are decoded right away, the data
+    payload only when it is accessed. Raises ValueError on a malformed packet.
+    """
+    view = memoryview(packet)
+    end = len(view)
+    pos = 0
+    id = 0
+    # error_id, mode, position
+    status = [0, 0, [0.0, 0.0, 0.0]]
+    payload = None
+    payload_field = 0
+    try:
+        while pos < end:
+            tag, pos = _read_varint(view, pos)
+            if tag == 0x08:
+                value, pos = _read_varint(view, pos)
+                id = value & _UINT32_MASK
+            elif tag == 0x12:
+                start, pos = _read_len(view, pos)
+                _decode_status(view, start, pos, status)
+            elif tag == 0x1A:
+                start, pos = _read_len(view, pos)
+                if payload_field == 3:
+                    # a repeated submessage is merged, same as parsing the concatenation
+                    payload = memoryview(bytes(payload) + bytes(view[start:pos]))
+                else:
+                    payload = view[start:pos]
+                payload_field = 3
+            elif tag == 0x20 or tag == 0x28:
+                payload, pos = _read_varint(view, pos)
+                payload_field = tag >> 3
+            else:
+                pos = _skip(view, pos, tag & 7)
+        if pos != end:
+            raise IndexError("field past the end")
+    except IndexError as err:
+        raise ValueError("truncated reply_msg") from err
+    reply = Reply(id, status[0], status[1], tuple(status[2]))
+    if payload_field == 3:
+        reply.set_raw_data(payload)
+    elif payload_field == 4:
+        reply.payload_gpio = payload != 0
+    elif payload_field == 5:
+        reply.payload_parameter = payload & _UINT32_MASK
+    return reply
+
+
+class PendingReply:
+    """
+    Handle for a submitted command, resolved when the reply
+    with the same id arrives.
+    """
+    def __init__(self, id, inst, sent, deadline, wait):
+        self.id = id
+        self.inst = inst
+        self.sent = sent
+        self.deadline = deadline
+        # when the result was set
+        self.received = None
+        self.__wait = wait
+        # the other commands of an abort on error batch
+        self.batch = None
+        # the sent frame, kept when the command may be retried
+        self.frame = None
+        self.attempts = 0
+        self.__result = None
+        self.__final = False
+        self.__event = threading.Event()
+
+    def set_result(self, result):
+        self.__result = result
+        self.received = time.monotonic()
+        self.__event.set()
+
+    def peek(self):
+        """
+        Result set so far, None while the command is in flight.
+        """
+        return self.__result
+
+    def retry(self, sent, deadline):
+        """
+        Clear the result before the command is sent again.
+        """
+        self.sent = sent
+        self.deadline = deadline
+        self.attempts += 1
+        self.__event.clear()
+        self.__result = None
+
+    def done(self):
+        return self.__result is not None
+
+    def wait(self, timeout):
+        """
+        Block until the result is set by another thread, or timeout.
+        """
+        return self.__event.wait(timeout)
+
+    def result(self):
+        """
+        Wait for the reply, returns the same (error, reply) tuple
+        as the blocking CubeComm methods.
+        """
+        if not self.__final:
+            self.__wait(self)
+            self.__final = True
+        return self.__result
+
 
 class CubeComm:
-    def __init__(self, id_start):
+    def __init__(self, id_start, reply_timeout=DEFAULT_REPLY_TIMEOUT,
+                 pipeline_window=DEFAULT_PIPELINE_WINDOW):
         self.__port = None
         self.id = id_start
+        self.__reply_timeout = reply_timeout
+        self.__inst_timeouts = {
+            cube_pb2.move_to: LONG_REPLY_TIMEOUT,
+            cube_pb2.home: LONG_REPLY_TIMEOUT,
+        }
+        self.__decoder = FrameDecoder()
+        # only used under the lock
+        self.__encoder = cube_commands.CommandEncoder()
+        self.__window = pipeline_window
+        self.__batch_frames = False
+        # CRC_FLAG or 0, or-ed into the frame types
+        self.__crc = 0
+        self.__extended = False
+        self.__transfer_chunk = cube_commands.TRANSFER_CHUNK
+        self.__retries = 0
+        self.__retry_backoff = DEFAULT_RETRY_BACKOFF
+        self.__retry_instructions = IDEMPOTENT_INSTRUCTIONS
+        # set when a frame never completed, the reading thread drops it
+        self.__resync = False
+        # updated from every reply, read without the lock
+        self.state = CubeState()
+        self.__cache = False
+        self.__skip_moves = False
+        # in flight commands by id, in the order they were sent
+        self.__pending = {}
+        # guards the pending table, ids and writes
+        self.__lock = threading.Lock()
+        # only one thread reads the port at a time
+        self.__io_lock = threading.Lock()
+        self.__reader = None
+        self.__reader_stop = threading.Event()
+        # None while disabled, so the hot path only pays for a None check
+        self.__stats = None
+        self.__frame_start = 0.0
+        self.__frame_end = 0.0
+        self.__decoder_base = (0, 0, 0)
+        self.__journal = None
 
     def __get_id(self):
         self.id += 1
         return self.id
 
-    def __send_data(self, msg_type, data):
-        msg_out = [0x55, 0x55, 0x55, msg_type, len(data)]
-        msg_out.extend(data)
-        self.__port.write(msg_out)
-
-    def __receive_data(self):
-        receive = []
-        while (len(receive) == 0):
-            receive = self.__port.read(300)
-        return receive
-
-    def __read_packet(self, data):
-        packet = []
-        header_found = 0
-        packet_length = 0
-        reading_data = False
-        reading_data_length = False
-        for i in range(len(data)):
-            if not (reading_data or reading_data_length):
-                if header_found == 3:
-                    msg_type = data[i]
-                    reading_data_length = True
-                    if (msg_type != 0x02):
-                        return ("cube_comm: wrong reply", None)
-                    continue
-                if data[i] != 0x55:
-                    header_found = 0
-                    continue
-                if data[i] == 0x55:
-                    header_found += 1
-                    continue
-            if reading_data_length:
-                packet_length = data[i]
-                reading_data = True
-                reading_data_length = False
-                continue
-            if reading_data:
-                if packet_length == 0:
-                    return ("cube_comm: no data", None)
-                packet.append(data[i])
-                packet_length -= 1
-        if (packet_length == 0 and not len(packet) == 0):
-            return (None, packet)
-        return ("cube_comm: lost data", None)
-
-
-    def __decode_receive(self, received):
-        error, packet = self.__read_packet(received)
+    def __send_frame(self, frame):
+        if self.__stats is not None:
+            self.__stats.bytes_out += len(frame)
+        journal = self.__journal
+        if journal is not None:
+            journal.write(RECORD_OUT, frame)
+        self.__port.write(frame)
+
+    def __get_timeout(self, inst):
+        return self.__inst_timeouts.get(inst, self.__reply_timeout)
+
+    def __receive(self, data):
+        stats = self.__stats
+        if stats is not None:
+            now = time.monotonic()
+            if len(self.__decoder) == 0:
+                self.__frame_start = now
+            self.__frame_end = now
+            stats.bytes_in += len(data)
+        journal = self.__journal
+        if journal is not None:
+            journal.write(RECORD_IN, data)
+        if self.__resync:
+            self.__resync = False
+            self.__decoder.resync()
+        frames = self.__decoder.feed(data)
+        with self.__lock:
+            for frame in frames:
+                self.__dispatch(frame)
+
+    def __dispatch(self, frame):
+        stats = self.__stats
+        if stats is not None:
+            stats.frames += 1
+        error, packet = check_frame(frame)
+        if not error:
+            try:
+                reply = decode_reply(packet)
+            except ValueError:
+                error = "cube_comm: bad reply"
         if error:
-            return (error, None)
-        msg = cube_pb2.reply_msg().FromString(bytearray(packet))
-        position = (msg.stat.pos.a, msg.stat.pos.b, msg.stat.pos.c)
-        reply = Reply(int(msg.id), int(msg.stat.error_id), int(msg.stat.mode), position)
-        if msg.HasField('data'):
-            reply.payload_data = (msg.data.length, msg.data.data)
-        elif msg.HasField('gpio_status'):
-            reply.payload_gpio = msg.gpio_status
-        elif msg.HasField('param_value'):
-            reply.payload_parameter = msg.param_value
-        return (error, reply)
-
-
-    def __send_simple_command(self, command):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = command
-
-        data = msg.SerializeToString()
-        self.__send_data(0x01, data)
-
-        data_in = self.__receive_data()
-        return self.__decode_receive(data_in)
-
-    def __send_msg(self, msg):
-        data = msg.SerializeToString()
-        self.__send_data(0x01, data)
-        data_in = self.__receive_data()
-        return self.__decode_receive(data_in)
+            if stats is not None:
+                stats.count_error(error)
+            # a broken frame can not be matched by id, the Cube answers
+            # in order so it belongs to the oldest command in flight
+            if len(self.__pending) > 0:
+                oldest = next(iter(self.__pending))
+                self.__pending.pop(oldest).set_result((error, None))
+            return
+        pending = self.__pending.pop(reply.id, None)
+        self.state.update(reply, None if pending is None else pending.inst)
+        if pending is not None:
+            pending.set_result((None, reply))
+            if pending.batch is not None and reply.error != 0:
+                self.__abort_batch(pending.batch)
+            if stats is not None:
+                stats.add_reply(pending.inst, self.__frame_start - pending.sent,
+                                self.__frame_end - pending.sent)
+        elif stats is not None:
+            # replies to commands that already timed out are dropped
+            stats.dropped_replies += 1
+        if stats is not None:
+            # the rest of the chunk is the start of the next frame
+            self.__frame_start = self.__frame_end
+
+    def __abort_batch(self, batch):
+        # the Cube skipped the rest of the batch after an error
+        for pending in batch:
+            if not pending.done():
+                self.__pending.pop(pending.id, None)
+                pending.set_result(("cube_comm: batch aborted", None))
+
+    def __expire(self, pending):
+        with self.__lock:
+            if pending.done():
+                return
+            self.__pending.pop(pending.id, None)
+            if pending.inst in MOVE_INSTRUCTIONS:
+                # it may still be moving
+                self.state.position_known = False
+            if len(self.__decoder) > 0:
+                error = "cube_comm: lost data"
+                self.__resync = True
+            else:
+                error = "cube_comm: no reply"
+            pending.set_result((error, None))
+            if self.__stats is not None:
+                self.__stats.count_error(error)
+
+    def __wait_for(self, pending):
+        if self.__reader is not None:
+            if not pending.wait(max(0, pending.deadline - time.monotonic())):
+                self.__expire(pending)
+            return
+        # without the reader thread the waiting caller reads the port itself,
+        # replies for other callers are handed over through the pending table
+        with self.__io_lock:
+            while not pending.done():
+                # read only what the pending frame still needs (or what is
+                # already waiting), so a reply is handled as soon as it is complete
+                count = max(self.__decoder.bytes_needed(), self.__port.in_waiting)
+                data = self.__port.read(count)
+                if len(data) > 0:
+                    self.__receive(data)
+                if not pending.done() and time.monotonic() > pending.deadline:
+                    self.__expire(pending)
+                    return
+
+    def __resolve(self, pending):
+        # waits for the result, sending the command again with the same id
+        # while the link fails, a late reply to an earlier attempt resolves it too
+        while True:
+            if not pending.done():
+                self.__wait_for(pending)
+            error, _ = pending.peek()
+            if error not in RETRY_ERRORS or pending.frame is None or pending.attempts >= self.__retries:
+                return
+            time.sleep(self.__retry_backoff * 2 ** pending.attempts)
+            with self.__lock:
+                if self.__port is None:
+                    return
+                now = time.monotonic()
+                pending.retry(now, now + self.__get_timeout(pending.inst))
+                self.__pending[pending.id] = pending
+                if self.__stats is not None:
+                    self.__stats.retries += 1
+                self.__send_frame(pending.frame)
+
+    def __reader_loop(self):
+        port = self.__port
+        while not self.__reader_stop.is_set():
+            try:
+                data = port.read(max(1, port.in_waiting))
+            except Exception as err:
+                with self.__lock:
+                    for pending in self.__pending.values():
+                        pending.set_result((f"cube_comm: port error {err}", None))
+                    self.__pending.clear()
+                return
+            if len(data) > 0:
+                self.__receive(data)
+
+    def start_reader(self):
+        """
+        Start a thread that owns the port and hands every reply to the
+        waiting caller. CubeComm can then be shared by several threads.
+        """
+        if self.__reader is not None:
+            return
+        self.__reader_stop.clear()
+        self.__reader = threading.Thread(target=self.__reader_loop, name="cube-reader", daemon=True)
+        self.__reader.start()
+
+    def stop_reader(self):
+        """
+        Stop the reader thread, waits at most one port timeout.
+        """
+        if self.__reader is None:
+            return
+        self.__reader_stop.set()
+        self.__reader.join()
+        self.__reader = None
+
+    def __not_connected(self, inst):
+        # resolved handle of a command that can not be sent
+        pending = PendingReply(0, inst, time.monotonic(), 0.0, self.__resolve)
+        pending.set_result(("cube_comm: not connected", None))
+        return pending
+
+    def __submit(self, inst, encode):
+        # encode(id) returns the frame to send, it runs under the lock
+        while True:
+            with self.__lock:
+                if self.__port is None:
+                    return self.__not_connected(inst)
+                if len(self.__pending) < self.__window:
+                    id = self.__get_id()
+                    # before registering, a command too long for a frame
+                    # raises without leaving a pending entry behind
+                    frame = encode(id)
+                    now = time.monotonic()
+                    pending = PendingReply(id, inst, now, now + self.__get_timeout(inst),
+                                           self.__resolve)
+                    if self.__stats is not None:
+                        self.__stats.commands += 1
+                    self.__pending[id] = pending
+                    if self.__retries > 0 and inst in self.__retry_instructions:
+                        pending.frame = bytes(frame)
+                    self.__send_frame(frame)
+                    return pending
+                oldest = next(iter(self.__pending.values()))
+            self.__wait_for(oldest)
+
+    def submit(self, msg):
+        """
+        Send a command without waiting for the reply.
+        Blocks only while the pipeline window is full.
+        Returns a PendingReply, replies are matched to commands by id.
+        """
+        def encode(id):
+            msg.id = id
+            return self.__encoder.encode(msg)
+        return self.__submit(msg.inst, encode)
+
+    def __submit_group(self, msgs, abort_on_error):
+        # sends all msgs in one write, the Cube runs them one after another
+        # so the deadlines add up
+        while True:
+            with self.__lock:
+                if self.__port is None:
+                    return [self.__not_connected(msg.inst) for msg in msgs]
+                if len(self.__pending) == 0 or len(self.__pending) + len(msgs) <= self.__window:
+                    packets = []
+                    for msg in msgs:
+                        msg.id = self.__get_id()
+                        packets.append(msg.SerializeToString())
+                    # everything is encoded before the commands are registered,
+                    # so one too long for a frame leaves no pending entries behind
+                    frames = None
+                    if not self.__batch_frames or self.__retries > 0:
+                        # a retry sends the command alone
+                        frames = [self.__frame(COMMAND_FRAME, packet) for packet in packets]
+                    if self.__batch_frames:
+                        flags = BATCH_ABORT_ON_ERROR if abort_on_error else 0
+                        frame = self.__frame(BATCH_COMMAND_FRAME, pack_batch(flags, packets))
+                    else:
+                        frame = b''.join(frames)
+                    now = time.monotonic()
+                    deadline = now
+                    group = []
+                    for i, msg in enumerate(msgs):
+                        deadline += self.__get_timeout(msg.inst)
+                        pending = PendingReply(msg.id, msg.inst, now, deadline, self.__resolve)
+                        self.__pending[msg.id] = pending
+                        group.append(pending)
+                        if self.__retries > 0 and msg.inst in self.__retry_instructions:
+                            pending.frame = frames[i]
+                    if abort_on_error:
+                        for pending in group:
+                            pending.batch = group
+                    if self.__stats is not None:
+                        self.__stats.commands += len(msgs)
+                    self.__send_frame(frame)
+                    return group
+                oldest = next(iter(self.__pending.values()))
+            self.__wait_for(oldest)
+
+    def __frame(self, kind, payload):
+        msg_type = kind | self.__crc
+        if self.__extended and len(payload) > FRAME_MAX_PAYLOAD - CRC_LENGTH:
+            msg_type |= EXTENDED_FLAG
+        return encode_frame(msg_type, payload)
+
+    def __batch_groups(self, msgs):
+        groups = []
+        if not self.__batch_frames:
+            for start in range(0, len(msgs), self.__window):
+                groups.append(msgs[start:start + self.__window])
+            return groups
+        # flags byte, then a length byte and the packet with up to a 5 byte id per command
+        limit = FRAME_MAX_PAYLOAD - (CRC_LENGTH if self.__crc else 0)
+        size = limit
+        for msg in msgs:
+            packet_size = 1 + msg.ByteSize() + 6
+            if size + packet_size > limit or len(groups[-1]) == self.__window:
+                groups.append([])
+                size = 1
+            groups[-1].append(msg)
+            size += packet_size
+        return groups
+
+    def __send_chunks(self, msgs):
+        # the data of a chunked transfer is merged into the last reply
+        received = bytearray()
+        for error, reply in self.send_batch(msgs, abort_on_error=True):
+            if error or reply.error != 0:
+                return (error, reply)
+            if reply.has_data():
+                received += reply.payload_data[1]
+        reply.payload_data = (len(received), bytes(received))
+        return (None, reply)
+
+    def __send_all(self, msgs, kind):
+        # first error of a batch, device errors included
+        results = self.send_batch(msgs)
+        for error, reply in results:
+            if error:
+                return (error, None)
+            if reply.error != 0:
+                return (f"cube_comm: {kind} error {reply.error}", None)
+        return (None, [reply for _, reply in results])
+
+    def __send_simple(self, inst):
+        return self.__submit(inst, lambda id: self.__encoder.encode_simple(id, inst)).result()
+
+    def __send_built(self, inst, builder, *args):
+        # fills the encoder's reused message instead of allocating one
+        def encode(id):
+            msg = builder(*args, msg=self.__encoder.message(inst))
+            msg.id = id
+            return self.__encoder.encode(msg)
+        return self.__submit(inst, encode).result()
 
     def set_serial_port(self, port):
-        self.__port = port
+        """
+        Set the port to use, stops the reader thread.
+        """
+        self.stop_reader()
+        with self.__lock:
+            self.__port = port
+            self.__decoder.reset()
+            self.state.clear()
+            for pending in self.__pending.values():
+                pending.set_result(("cube_comm: port changed", None))
+            self.__pending.clear()
+
+    def send_batch(self, commands, abort_on_error=False):
+        """
+        Send several command_msgs with as few writes as possible and wait
+        for all of them. Returns a list of (error, reply) tuples in order.
+        With abort_on_error the commands after the first one that fails are
+        not executed and get "cube_comm: batch aborted".
+        """
+        commands = list(commands)
+        for msg in commands:
+            self.state.invalidate_msg(msg)
+        if abort_on_error and not self.__batch_frames:
+            # plain frames can not be taken back, send one at a time
+            groups = [[msg] for msg in commands]
+        else:
+            groups = self.__batch_groups(commands)
+        pending = []
+        for group in groups:
+            if abort_on_error and len(pending) > 0:
+                error, reply = pending[-1].result()
+                if error or reply.error != 0:
+                    break
+            pending += self.__submit_group(group, abort_on_error)
+        results = [handle.result() for handle in pending]
+        results += [("cube_comm: batch aborted", None)] * (len(commands) - len(results))
+        for msg, result in zip(commands, results):
+            self.state.record_msg(msg, result)
+        return results
+
+    def i2c_transaction(self, address):
+        """
+        Start building an I2CTransaction with the device at address.
+        """
+        return I2CTransaction(self, address)
+
+    def enable_cache(self, enable=True):
+        """
+        Answer get_parameter and get_parameters from the state mirror when
+        the value is known. Only valid while nothing else changes the
+        parameters, cached replies have id 0.
+        """
+        self.__cache = enable
+
+    def set_skip_moves(self, enable=True):
+        """
+        Answer move_to without sending it when the Cube already reports
+        the target position and no command is in flight.
+        """
+        self.__skip_moves = enable
+
+    def __cached_reply(self, **payload):
+        if self.__stats is not None:
+            self.__stats.cached += 1
+        return Reply(0, 0, self.state.mode, self.state.position, **payload)
+
+    def __send_recorded(self, inst, builder, key, value):
+        # set and get commands whose result is kept in the state mirror
+        self.state.invalidate(inst, key)
+        result = self.__send_built(inst, builder, key, value)
+        self.state.record(inst, key, value, result)
+        return result
+
+    def set_batch_frames(self, enable=True):
+        """
+        Send batches as one batch frame instead of pipelined command frames,
+        needs a firmware that understands them.
+        """
+        self.__batch_frames = enable
+
+    def set_crc_frames(self, enable=True):
+        """
+        Protect commands and their replies with a CRC, needs a firmware
+        that understands CRC frames.
+        """
+        with self.__lock:
+            self.__crc = CRC_FLAG if enable else 0
+            self.__encoder.set_crc(enable)
+
+    def set_extended_frames(self, enable=True):
+        """
+        Send commands too long for a plain frame in extended length frames,
+        needs a firmware that understands them.
+        """
+        with self.__lock:
+            self.__extended = enable
+            self.__encoder.set_extended(enable)
+
+    @property
+    def transfer_chunk(self):
+        return self.__transfer_chunk
+
+    def set_transfer_chunk(self, size):
+        """
+        Set the largest SPI or I2C transfer the firmware can buffer.
+        Longer I2C reads are split into chunks of this size, see
+        i2c_transfer() and spi_transfer() for what is not. Transfers
+        too long for a frame need set_extended_frames(), else they
+        return an error.
+        """
+        self.__transfer_chunk = max(1, size)
+
+    def set_retries(self, retries, backoff=DEFAULT_RETRY_BACKOFF, instructions=IDEMPOTENT_INSTRUCTIONS):
+        """
+        Send a command again, with the same id, when its reply is lost or
+        broken. Waits backoff seconds before the first retry and doubles it
+        for every further one. Only instructions in instructions are retried.
+        """
+        self.__retries = retries
+        self.__retry_backoff = backoff
+        self.__retry_instructions = frozenset(instructions)
+
+    def set_reply_timeout(self, timeout, inst=None):
+        """
+        Set how long to wait for a reply, in seconds.
+        If inst is given, the timeout only applies to that instruction.
+        """
+        if inst is None:
+            self.__reply_timeout = timeout
+        else:
+            self.__inst_timeouts[inst] = timeout
+
+    def __decoder_counters(self):
+        return (self.__decoder.resyncs, self.__decoder.dropped_bytes, self.__decoder.crc_errors)
+
+    def start_journal(self, path):
+        """
+        Append every write to and read from the port to the journal at
+        path, see cube_journal. Replay it with cube_replay.
+        """
+        self.stop_journal()
+        self.__journal = CubeJournal(path)
+
+    def stop_journal(self):
+        journal, self.__journal = self.__journal, None
+        if journal is not None:
+            journal.close()
+
+    def enable_stats(self, enable=True):
+        """
+        Turn collecting of I/O counters and latency histograms on or off.
+        """
+        if enable and self.__stats is None:
+            self.__stats = CommStats()
+            self.__decoder_base = self.__decoder_counters()
+        elif not enable:
+            self.__stats = None
+
+    def reset_stats(self):
+        if self.__stats is not None:
+            self.__stats.reset()
+            self.__decoder_base = self.__decoder_counters()
+
+    def stats_snapshot(self):
+        """
+        Current counters as a dict, None if stats are disabled.
+        """
+        if self.__stats is None:
+            return None
+        snapshot = self.__stats.snapshot()
+        counters = self.__decoder_counters()
+        snapshot["resyncs"] = counters[0] - self.__decoder_base[0]
+        snapshot["dropped_bytes"] = counters[1] - self.__decoder_base[1]
+        snapshot["crc_errors"] = counters[2] - self.__decoder_base[2]
+        return snapshot
+
+    def stats_summary(self):
+        if self.__stats is None:
+            return "Stats disabled"
+        return self.__stats.summary()
+
+    def set_pipeline_window(self, window):
+        """
+        Set how many submitted commands may wait for a reply at once.
+        """
+        self.__window = max(1, window)
 
     def status(self):
-        return self.__send_simple_command(cube_pb2.status_i)
+        return self.__send_simple(cube_pb2.status_i)
 
     def absolute_pos(self):
-        return self.__send_simple_command(cube_pb2.get_abs_pos)
+        return self.__send_simple(cube_pb2.get_abs_pos)
 
     def relative_pos(self):
-        return self.__send_simple_command(cube_pb2.get_rel_pos)
+        return self.__send_simple(cube_pb2.get_rel_pos)
 
     def set_zero(self):
-        return self.__send_simple_command(cube_pb2.set_zero_pos)
+        return self.__send_simple(cube_pb2.set_zero_pos)
 
     def reset_zero(self):
-        return self.__send_simple_command(cube_pb2.reset_zero_pos)
+        return self.__send_simple(cube_pb2.reset_zero_pos)
 
     def home(self):
-        return self.__send_simple_command(cube_pb2.home)
+        return self.__send_simple(cube_pb2.home)
 
     def move_to(self, a, b, c):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.move_to
-        msg.pos.a = a
-        msg.pos.b = b
-        msg.pos.c = c
-        return self.__send_msg(msg)
-
+        if self.__skip_moves:
+            with self.__lock:
+                skip = len(self.__pending) == 0 and self.state.at((a, b, c))
+            if skip:
+                return (None, self.__cached_reply())
+        return self.__send_built(cube_pb2.move_to, cube_commands.move_to, a, b, c)
 
     def set_coordinate_mode(self, mode):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.set_coordinate_mode
-        if (mode == 0):
-            msg.mode = cube_pb2.cartesian
-        if (mode == 1):
-            msg.mode = cube_pb2.cylindrical
-        if (mode == 2):
-            msg.mode = cube_pb2.spherical
-        return self.__send_msg(msg)
-
-    def spi_transfer(self, cs, mode, length, data):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.spi_transfer
-        msg.spi.cs = cs
-        msg.spi.length = length
-        msg.spi.data = bytes(data + ([0] * (64 - length)))
-        return self.__send_msg(msg)
+        return self.__send_built(cube_pb2.set_coordinate_mode, cube_commands.set_coordinate_mode, mode)
+
+    def __send_encoded(self, send, *args):
+        # a transfer chunk too long for a frame without extended frames
+        # fails in the encoder, before anything is sent
+        try:
+            return send(*args)
+        except ValueError as err:
+            return (f"cube_comm: {err}", None)
+
+    def spi_transfer(self, cs, mode, length, data, split=False):
+        """
+        A transfer longer than the transfer chunk is an error, unless split
+        is set. Then it is sent as several transfers and chip select is
+        released between them, only right for devices that do not need
+        one transfer, like shift registers or loopbacks.
+        """
+        if length > self.__transfer_chunk:
+            if not split:
+                return (f"cube_comm: SPI transfer of {length} bytes is larger than {self.__transfer_chunk}", None)
+            return self.__send_encoded(self.__send_chunks,
+                                       cube_commands.spi_transfer_chunks(cs, mode, length, data, self.__transfer_chunk))
+        return self.__send_encoded(self.__send_built, cube_pb2.spi_transfer, cube_commands.spi_transfer,
+                                   cs, mode, length, data)
 
     def i2c_transfer(self, rx_len, tx_len, addr, data):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.i2c_transfer
-        msg.i2c.rx_length = rx_len
-        msg.i2c.tx_length = tx_len
-        msg.i2c.address = addr
-        msg.i2c.data = bytes(data + ([0] * (64 - tx_len)))
-        return self.__send_msg(msg)
+        """
+        Reads longer than the transfer chunk are continued by read only
+        transfers, writes longer than it are an error.
+        """
+        if tx_len > self.__transfer_chunk:
+            return (f"cube_comm: I2C write of {tx_len} bytes is larger than {self.__transfer_chunk}", None)
+        if rx_len > self.__transfer_chunk:
+            return self.__send_encoded(self.__send_chunks,
+                                       cube_commands.i2c_transfer_chunks(rx_len, tx_len, addr, data,
+                                                                         self.__transfer_chunk))
+        return self.__send_encoded(self.__send_built, cube_pb2.i2c_transfer, cube_commands.i2c_transfer,
+                                   rx_len, tx_len, addr, data)
 
     def set_gpio_mode(self, index, mode):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.set_gpio_mode
-        msg.gpio.index = index
-        msg.gpio.value = mode
-        return self.__send_msg(msg)
+        return self.__send_recorded(cube_pb2.set_gpio_mode, cube_commands.set_gpio_mode, index, mode)
 
     def set_gpio(self, index, value):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.set_gpio
-        msg.gpio.index = index
-        msg.gpio.value = value
-        return self.__send_msg(msg)
+        return self.__send_recorded(cube_pb2.set_gpio, cube_commands.set_gpio, index, value)
 
     def get_gpio(self, index):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.get_gpio
-        msg.gpio.index = index
-        msg.gpio.value = True
-        return self.__send_msg(msg)
+        return self.__send_built(cube_pb2.get_gpio, cube_commands.get_gpio, index)
+
+    def get_parameters(self, ids):
+        """
+        Read several parameters pipelined, returns (error, {id: value}).
+        """
+        ids = list(ids)
+        values = {}
+        if self.__cache:
+            values = {id: self.state.parameters[id] for id in ids if id in self.state.parameters}
+            if self.__stats is not None:
+                self.__stats.cached += len(values)
+        ids = [id for id in ids if id not in values]
+        error, replies = self.__send_all([cube_commands.get_parameter(id) for id in ids], "parameter")
+        if error:
+            return (error, None)
+        values.update((id, reply.payload_parameter or 0) for id, reply in zip(ids, replies))
+        return (None, values)
+
+    def set_parameters(self, parameters):
+        """
+        Write a {id: value} dict of parameters pipelined, returns (error, replies).
+        """
+        return self.__send_all([cube_commands.set_parameter(id, value)
+                                for id, value in parameters.items()], "parameter")
+
+    def save_parameters(self, path, ids):
+        """
+        Read the parameters in ids and save them to a snapshot file,
+        returns (error, {id: value}).
+        """
+        error, parameters = self.get_parameters(ids)
+        if not error:
+            write_parameter_file(path, parameters)
+        return (error, parameters)
+
+    def restore_parameters(self, parameters):
+        """
+        Bring the parameters to the values of a {id: value} dict or a
+        snapshot file. Current values are read first and only the ones that
+        differ are written, returns (error, {id: value}) of the written ones.
+        """
+        if isinstance(parameters, (str, os.PathLike)):
+            parameters = read_parameter_file(parameters)
+        error, current = self.get_parameters(parameters)
+        if error:
+            return (error, None)
+        changed = {id: value for id, value in parameters.items() if current[id] != value}
+        if len(changed) > 0:
+            error, _ = self.set_parameters(changed)
+        return (error, changed)
+
+    def set_gpios(self, mask, values):
+        """
+        Set every pin in mask to its bit in values, an integer bitmask or a
+        sequence of bools indexed by pin. Returns (error, replies).
+        """
+        return self.__send_all(cube_commands.set_gpios(mask, values), "gpio")
+
+    def configure_gpios(self, mask, modes):
+        """
+        Set the mode of every pin in mask, like set_gpios.
+        """
+        return self.__send_all(cube_commands.set_gpio_modes(mask, modes), "gpio")
+
+    def get_gpios(self, mask, as_array=False):
+        """
+        Read every pin in mask. Returns (error, state), state is an integer
+        bitmask or, with as_array, a NumPy bool array indexed by pin.
+        """
+        error, replies = self.__send_all(cube_commands.get_gpios(mask), "gpio")
+        if error:
+            return (error, None)
+        state = 0
+        for pin, reply in zip(cube_commands.mask_pins(mask), replies):
+            if reply.payload_gpio:
+                state |= 1 << pin
+        if as_array:
+            return (None, np.array([(state >> pin) & 1 for pin in range(mask.bit_length())], dtype=bool))
+        return (None, state)
 
     def set_parameter(self, id, value):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.set_parameter
-        msg.param.id = id
-        msg.param.value = value
-        return self.__send_msg(msg)
+        return self.__send_recorded(cube_pb2.set_parameter, cube_commands.set_parameter, id, value)
 
     def get_parameter(self, id):
-        msg = cube_pb2.command_msg()
-        msg.id = self.__get_id()
-        msg.inst = cube_pb2.get_parameter
-        msg.param.id = id
-        msg.param.value = 0
-        return self.__send_msg(msg)
+        if self.__cache and id in self.state.parameters:
+            return (None, self.__cached_reply(payload_parameter=self.state.parameters[id]))
+        result = self.__send_built(cube_pb2.get_parameter, cube_commands.get_parameter, id)
+        self.state.record(cube_pb2.get_parameter, id, None, result)
+        return result
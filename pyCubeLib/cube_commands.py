@@ -0,0 +1,284 @@
+from pyCubeLib import cube_pb2
+from pyCubeLib.cube_frame import crc16, encode_frame, FRAME_SYNC, FRAME_HEADER_LENGTH, FRAME_MAX_PAYLOAD, \
+    COMMAND_FRAME, CRC_FLAG, CRC_LENGTH, EXTENDED_FLAG
+
+# Builders for command messages. The id is left empty, it is stamped by
+# CubeComm when the command is sent. Every builder can fill a message
+# passed in msg instead of allocating a new one.
+
+# instructions without a payload, their frames only differ in the id
+SIMPLE_INSTRUCTIONS = (
+    cube_pb2.status_i,
+    cube_pb2.get_abs_pos,
+    cube_pb2.get_rel_pos,
+    cube_pb2.set_zero_pos,
+    cube_pb2.reset_zero_pos,
+    cube_pb2.home,
+)
+
+# bytes of one SPI or I2C transfer the firmware can buffer
+TRANSFER_CHUNK = 64
+
+
+def new_message(inst, msg=None):
+    if msg is None:
+        msg = cube_pb2.command_msg()
+    else:
+        msg.Clear()
+    msg.inst = inst
+    return msg
+
+
+def simple_command(inst, msg=None):
+    return new_message(inst, msg)
+
+
+def status(msg=None):
+    return simple_command(cube_pb2.status_i, msg)
+
+
+def absolute_pos(msg=None):
+    return simple_command(cube_pb2.get_abs_pos, msg)
+
+
+def relative_pos(msg=None):
+    return simple_command(cube_pb2.get_rel_pos, msg)
+
+
+def set_zero(msg=None):
+    return simple_command(cube_pb2.set_zero_pos, msg)
+
+
+def reset_zero(msg=None):
+    return simple_command(cube_pb2.reset_zero_pos, msg)
+
+
+def home(msg=None):
+    return simple_command(cube_pb2.home, msg)
+
+
+def move_to(a, b, c, msg=None):
+    msg = new_message(cube_pb2.move_to, msg)
+    msg.pos.a = a
+    msg.pos.b = b
+    msg.pos.c = c
+    return msg
+
+
+def set_coordinate_mode(mode, msg=None):
+    msg = new_message(cube_pb2.set_coordinate_mode, msg)
+    if (mode == 0):
+        msg.mode = cube_pb2.cartesian
+    if (mode == 1):
+        msg.mode = cube_pb2.cylindrical
+    if (mode == 2):
+        msg.mode = cube_pb2.spherical
+    return msg
+
+
+def transfer_data(data, length):
+    """
+    The first length bytes of data, zero padded when data is shorter.
+    """
+    return bytes(data[:length]).ljust(length, b'\x00')
+
+
+def spi_transfer(cs, mode, length, data, msg=None):
+    msg = new_message(cube_pb2.spi_transfer, msg)
+    msg.spi.cs = cs
+    msg.spi.length = length
+    msg.spi.data = transfer_data(data, length)
+    return msg
+
+
+def i2c_transfer(rx_len, tx_len, addr, data, msg=None):
+    msg = new_message(cube_pb2.i2c_transfer, msg)
+    msg.i2c.rx_length = rx_len
+    msg.i2c.tx_length = tx_len
+    msg.i2c.address = addr
+    msg.i2c.data = transfer_data(data, tx_len)
+    return msg
+
+
+def spi_transfer_chunks(cs, mode, length, data, chunk=TRANSFER_CHUNK):
+    """
+    Split an SPI transfer into transfers of at most chunk bytes, the
+    received data is the concatenation of their replies. Every chunk is a
+    transfer of its own, chip select is released in between, so a device
+    command can not continue into the next chunk.
+    """
+    data = transfer_data(data, length)
+    return [spi_transfer(cs, mode, min(chunk, length - start), data[start:start + chunk])
+            for start in range(0, max(length, 1), chunk)]
+
+
+def i2c_transfer_chunks(rx_len, tx_len, addr, data, chunk=TRANSFER_CHUNK):
+    """
+    Split the read of an I2C transfer into transfers of at most chunk
+    bytes. The written bytes go once with the first read, the rest is read
+    by read only transfers, so the device has to continue where the
+    previous read stopped, like EEPROMs and most sensors do. Writes are
+    not split, a device would take the bytes starting a new transaction
+    as a new address. Raises ValueError if tx_len is larger than chunk.
+    """
+    if tx_len > chunk:
+        raise ValueError(f"I2C write of {tx_len} bytes is larger than a transfer of {chunk}")
+    first = min(chunk, rx_len)
+    msgs = [i2c_transfer(first, tx_len, addr, data)]
+    for start in range(first, rx_len, chunk):
+        msgs.append(i2c_transfer(min(chunk, rx_len - start), 0, addr, []))
+    return msgs
+
+
+def set_gpio_mode(index, mode, msg=None):
+    msg = new_message(cube_pb2.set_gpio_mode, msg)
+    msg.gpio.index = index
+    msg.gpio.value = mode
+    return msg
+
+
+def set_gpio(index, value, msg=None):
+    msg = new_message(cube_pb2.set_gpio, msg)
+    msg.gpio.index = index
+    msg.gpio.value = value
+    return msg
+
+
+def get_gpio(index, msg=None):
+    msg = new_message(cube_pb2.get_gpio, msg)
+    msg.gpio.index = index
+    msg.gpio.value = True
+    return msg
+
+
+def mask_pins(mask):
+    """
+    Indexes of the set bits of mask, lowest first.
+    """
+    return [pin for pin in range(mask.bit_length()) if (mask >> pin) & 1]
+
+
+def pins_mask(values):
+    """
+    Bitmask of an integer or of a sequence of bools indexed by pin.
+    """
+    if isinstance(values, int):
+        return values
+    return sum(1 << pin for pin, value in enumerate(values) if value)
+
+
+def set_gpios(mask, values):
+    values = pins_mask(values)
+    return [set_gpio(pin, bool((values >> pin) & 1)) for pin in mask_pins(mask)]
+
+
+def set_gpio_modes(mask, modes):
+    modes = pins_mask(modes)
+    return [set_gpio_mode(pin, bool((modes >> pin) & 1)) for pin in mask_pins(mask)]
+
+
+def get_gpios(mask):
+    return [get_gpio(pin) for pin in mask_pins(mask)]
+
+
+def set_parameter(id, value, msg=None):
+    msg = new_message(cube_pb2.set_parameter, msg)
+    msg.param.id = id
+    msg.param.value = value
+    return msg
+
+
+def get_parameter(id, msg=None):
+    msg = new_message(cube_pb2.get_parameter, msg)
+    msg.param.id = id
+    msg.param.value = 0
+    return msg
+
+
+def encode_varint(buffer, pos, value):
+    while value > 0x7F:
+        buffer[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    buffer[pos] = value
+    return pos + 1
+
+
+class CommandEncoder:
+    """
+    Encodes command frames into one reused buffer.
+
+    Payloadless instructions are not serialized at all, the id is written
+    in front of a pre-serialized template. For the others one message
+    object per instruction is reused. Not thread safe, the returned frame
+    is only valid until the next call.
+    """
+    def __init__(self, crc=False, extended=False):
+        self.__buffer = bytearray(FRAME_HEADER_LENGTH + FRAME_MAX_PAYLOAD)
+        self.__buffer[0:3] = FRAME_SYNC
+        self.__view = memoryview(self.__buffer)
+        self.set_crc(crc)
+        self.set_extended(extended)
+        self.__messages = {}
+        self.__templates = {}
+        for inst in SIMPLE_INSTRUCTIONS:
+            self.__templates[inst] = simple_command(inst).SerializeToString()
+
+    def set_crc(self, enable):
+        """
+        Encode CRC frames instead of plain ones.
+        """
+        self.__crc = enable
+        self.__buffer[3] = COMMAND_FRAME | CRC_FLAG if enable else COMMAND_FRAME
+
+    def set_extended(self, enable):
+        """
+        Encode messages too long for a frame into extended length frames
+        instead of raising ValueError.
+        """
+        self.__extended = enable
+
+    def __finish(self, end):
+        # fills in the length and the CRC of the payload written up to end
+        if self.__crc:
+            self.__buffer[4] = end + CRC_LENGTH - FRAME_HEADER_LENGTH
+            check = crc16(self.__view[3:end])
+            self.__buffer[end] = check >> 8
+            self.__buffer[end + 1] = check & 0xFF
+            end += CRC_LENGTH
+        else:
+            self.__buffer[4] = end - FRAME_HEADER_LENGTH
+        return self.__view[:end]
+
+    def message(self, inst):
+        """
+        Cleared message for inst, reused between calls.
+        """
+        msg = self.__messages.get(inst)
+        if msg is None:
+            msg = self.__messages[inst] = cube_pb2.command_msg()
+        return new_message(inst, msg)
+
+    def encode(self, msg):
+        payload = msg.SerializeToString()
+        size = len(payload)
+        if size > FRAME_MAX_PAYLOAD - (CRC_LENGTH if self.__crc else 0):
+            if self.__extended:
+                return encode_frame(self.__buffer[3] | EXTENDED_FLAG, payload)
+            raise ValueError(f"frame payload too long: {size}")
+        self.__buffer[FRAME_HEADER_LENGTH:FRAME_HEADER_LENGTH + size] = payload
+        return self.__finish(FRAME_HEADER_LENGTH + size)
+
+    def encode_simple(self, id, inst):
+        """
+        Frame of a payloadless instruction, same bytes as encode() would give.
+        """
+        template = self.__templates[inst]
+        pos = FRAME_HEADER_LENGTH
+        if id != 0:
+            # field 1, varint
+            self.__buffer[pos] = 0x08
+            pos = encode_varint(self.__buffer, pos + 1, id)
+        end = pos + len(template)
+        self.__buffer[pos:end] = template
+        return self.__finish(end)
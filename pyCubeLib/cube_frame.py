@@ -0,0 +1,226 @@
+import binascii
+
+FRAME_SYNC = b'\x55\x55\x55'
+FRAME_HEADER_LENGTH = 5
+FRAME_MAX_PAYLOAD = 255
+
+COMMAND_FRAME = 0x01
+REPLY_FRAME = 0x02
+# several length prefixed command_msgs executed back to back, each one is
+# answered with its own reply frame
+BATCH_COMMAND_FRAME = 0x03
+
+# set in the type of a frame that ends with a CRC-16/CCITT of its type,
+# length and message bytes, the length byte counts the CRC too
+CRC_FLAG = 0x10
+CRC_LENGTH = 2
+
+# set in the type of a frame with a two byte big endian length, for bulk data
+EXTENDED_FLAG = 0x20
+EXTENDED_HEADER_LENGTH = 6
+EXTENDED_MAX_PAYLOAD = 0xFFFF
+
+FRAME_FLAGS = CRC_FLAG | EXTENDED_FLAG
+
+# flags of a batch, the first byte of its payload
+BATCH_ABORT_ON_ERROR = 0x01
+
+
+def crc16(data):
+    """
+    CRC-16/CCITT-FALSE, polynomial 0x1021 and initial value 0xFFFF.
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def frame_kind(msg_type):
+    """
+    Frame type without the CRC and extended length flags.
+    """
+    return msg_type & ~FRAME_FLAGS
+
+
+def encode_frame(msg_type, data):
+    """
+    Wrap data into a 0x55 0x55 0x55 / type / length frame,
+    with a CRC when msg_type has CRC_FLAG set and a two byte
+    length when it has EXTENDED_FLAG set.
+    """
+    length = len(data)
+    if msg_type & CRC_FLAG:
+        length += CRC_LENGTH
+    if msg_type & EXTENDED_FLAG:
+        if length > EXTENDED_MAX_PAYLOAD:
+            raise ValueError(f"frame payload too long: {length}")
+        header = bytes((msg_type, length >> 8, length & 0xFF))
+    elif length > FRAME_MAX_PAYLOAD:
+        raise ValueError(f"frame payload too long: {length}")
+    else:
+        header = bytes((msg_type, length))
+    if msg_type & CRC_FLAG:
+        return FRAME_SYNC + header + data + crc16(header + data).to_bytes(CRC_LENGTH, 'big')
+    return FRAME_SYNC + header + data
+
+
+def pack_batch(flags, packets):
+    """
+    Payload of a batch frame, the flags byte followed by length prefixed packets.
+    """
+    payload = bytearray((flags,))
+    for packet in packets:
+        if len(packet) > 0xFF:
+            raise ValueError(f"batch packet too long: {len(packet)}")
+        payload.append(len(packet))
+        payload += packet
+    if len(payload) > FRAME_MAX_PAYLOAD:
+        raise ValueError(f"frame payload too long: {len(payload)}")
+    return bytes(payload)
+
+
+def unpack_batch(payload):
+    """
+    Split a batch frame payload, returns (flags, list of packets).
+    """
+    if len(payload) == 0:
+        raise ValueError("empty batch")
+    packets = []
+    pos = 1
+    while pos < len(payload):
+        end = pos + 1 + payload[pos]
+        if end > len(payload):
+            raise ValueError("truncated batch")
+        packets.append(payload[pos + 1:end])
+        pos = end
+    return (payload[0], packets)
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for the Cube framing.
+
+    Accepts arbitrary chunks of the byte stream, returns every complete
+    frame as a (type, payload) tuple and keeps the incomplete rest for the
+    next call. Bytes that do not belong to a frame are skipped until the
+    next sync sequence.
+
+    Every type is also accepted with CRC_FLAG and EXTENDED_FLAG set. The CRC is checked and
+    stripped, a frame that fails the check is returned with None as
+    payload and scanning continues one byte after its sync, so a corrupted
+    length can not swallow the frames behind it.
+    """
+    def __init__(self, frame_types=(COMMAND_FRAME, REPLY_FRAME, BATCH_COMMAND_FRAME), capacity=1024):
+        self.__types = frozenset(t | flags for t in frame_types
+                                 for flags in (0, CRC_FLAG, EXTENDED_FLAG, FRAME_FLAGS))
+        self.__buffer = bytearray(capacity)
+        self.__start = 0
+        self.__end = 0
+        self.dropped_bytes = 0
+        self.resyncs = 0
+        self.crc_errors = 0
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __append(self, data):
+        size = len(data)
+        if self.__end + size > len(self.__buffer):
+            # move the unread bytes to the front, grow only when that is not enough
+            used = self.__end - self.__start
+            if used > 0:
+                self.__buffer[0:used] = self.__buffer[self.__start:self.__end]
+            self.__start = 0
+            self.__end = used
+            if used + size > len(self.__buffer):
+                self.__buffer.extend(bytes(used + size - len(self.__buffer)))
+        self.__buffer[self.__end:self.__end + size] = data
+        self.__end += size
+
+    def __skip(self, count):
+        self.__start += count
+        self.dropped_bytes += count
+        self.resyncs += 1
+
+    def bytes_needed(self):
+        """
+        Minimal number of bytes needed to complete the pending frame.
+        """
+        used = self.__end - self.__start
+        if used < FRAME_HEADER_LENGTH:
+            return FRAME_HEADER_LENGTH - used
+        start = self.__start
+        if self.__buffer[start + 3] & EXTENDED_FLAG:
+            if used < EXTENDED_HEADER_LENGTH:
+                return EXTENDED_HEADER_LENGTH - used
+            header = EXTENDED_HEADER_LENGTH
+            length = (self.__buffer[start + 4] << 8) | self.__buffer[start + 5]
+        else:
+            header = FRAME_HEADER_LENGTH
+            length = self.__buffer[start + 4]
+        return max(1, header + length - used)
+
+    def resync(self):
+        """
+        Give up on the frame at the start of the buffer, used when it never
+        completes. The next feed() looks for a frame behind its sync.
+        """
+        if self.__end > self.__start:
+            self.__skip(1)
+
+    def reset(self):
+        """
+        Drop all buffered bytes.
+        """
+        self.__start = 0
+        self.__end = 0
+
+    def feed(self, data):
+        """
+        Add a chunk of received bytes, return a list of complete frames,
+        the payload is None for a frame with a wrong CRC.
+        """
+        if len(data) > 0:
+            self.__append(data)
+        frames = []
+        buffer = self.__buffer
+        with memoryview(buffer) as view:
+            while self.__end - self.__start >= FRAME_HEADER_LENGTH:
+                pos = buffer.find(FRAME_SYNC, self.__start, self.__end)
+                if pos < 0:
+                    # keep a possible partial sync sequence at the end
+                    keep = 0
+                    while keep < 2 and buffer[self.__end - keep - 1] == 0x55:
+                        keep += 1
+                    self.__skip(self.__end - self.__start - keep)
+                    break
+                if pos > self.__start:
+                    self.__skip(pos - self.__start)
+                    continue
+                msg_type = buffer[pos + 3]
+                if msg_type not in self.__types:
+                    self.__skip(1)
+                    continue
+                if msg_type & EXTENDED_FLAG:
+                    if self.__end - pos < EXTENDED_HEADER_LENGTH:
+                        break
+                    start = pos + EXTENDED_HEADER_LENGTH
+                    end = start + ((buffer[pos + 4] << 8) | buffer[pos + 5])
+                else:
+                    start = pos + FRAME_HEADER_LENGTH
+                    end = start + buffer[pos + 4]
+                if end > self.__end:
+                    break
+                payload_end = end
+                if msg_type & CRC_FLAG:
+                    payload_end -= CRC_LENGTH
+                    if (payload_end < start or
+                            crc16(view[pos + 3:payload_end]) != int.from_bytes(view[payload_end:end], 'big')):
+                        self.crc_errors += 1
+                        frames.append((msg_type, None))
+                        self.__skip(1)
+                        continue
+                frames.append((msg_type, bytes(view[start:payload_end])))
+                self.__start = end
+        if self.__start == self.__end:
+            self.__start = 0
+            self.__end = 0
+        return frames
@@ -0,0 +1,91 @@
+import time
+from pyCubeLib import cube_commands
+
+
+class I2CTransaction:
+    """
+    Sequence of transfers to one I2C device, run as a single submission.
+
+    Steps between two delays are pipelined, a delay waits for all replies
+    before it. Status checks look at the bytes read by the step before
+    them and are evaluated on the host, a failing check stops the
+    transaction at the next delay. Steps are chained:
+
+        error, reads = (cube.i2c_transaction(0x0C)
+                        .read(1, [0x3F]).check_status(0x10)
+                        .delay(0.3)
+                        .read(9, [0x4F]).check_status(0x10)
+                        .run())
+    """
+    def __init__(self, cube, address):
+        self.__cube = cube
+        self.address = address
+        # [rx_len, tx bytes, checks] per transfer, a float for a delay
+        self.__steps = []
+
+    def write(self, data):
+        """
+        Write data, nothing is read back.
+        """
+        self.__steps.append([0, bytes(data), []])
+        return self
+
+    def read(self, length, data=()):
+        """
+        Write data, usually a command or register address, then read
+        length bytes. The bytes are returned by run().
+        """
+        self.__steps.append([length, bytes(data), []])
+        return self
+
+    def delay(self, seconds):
+        """
+        Wait for every reply so far, then seconds more.
+        """
+        self.__steps.append(float(seconds))
+        return self
+
+    def check_status(self, mask, expect=0, index=0):
+        """
+        Fail unless byte index of the previous read has the bits in mask
+        equal to expect, e.g. an error flag of a status byte being clear.
+        """
+        if len(self.__steps) == 0 or isinstance(self.__steps[-1], float) or self.__steps[-1][0] <= index:
+            raise ValueError("check_status needs a read of at least index + 1 bytes before it")
+        self.__steps[-1][2].append((mask, expect, index))
+        return self
+
+    def __segments(self):
+        segment = []
+        for step in self.__steps:
+            if isinstance(step, float):
+                yield segment, step
+                segment = []
+            else:
+                segment.append(step)
+        yield segment, 0.0
+
+    def run(self):
+        """
+        Run all steps, returns (error, reads) with the bytes of every read
+        in order. On an error reads holds what was read before it.
+        """
+        reads = []
+        for segment, delay in self.__segments():
+            msgs = [cube_commands.i2c_transfer(rx_len, len(data), self.address, data)
+                    for rx_len, data, _ in segment]
+            for (rx_len, _, checks), (error, reply) in zip(segment, self.__cube.send_batch(msgs)):
+                if error:
+                    return (error, reads)
+                if reply.error != 0:
+                    return (f"cube_comm: i2c error {reply.error}", reads)
+                if rx_len == 0:
+                    continue
+                data = reply.get_payload()[1]
+                reads.append(data)
+                for mask, expect, index in checks:
+                    if index >= len(data) or data[index] & mask != expect:
+                        return ("cube_comm: status check failed", reads)
+            if delay > 0:
+                time.sleep(delay)
+        return (None, reads)
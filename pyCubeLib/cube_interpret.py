@@ -1,5 +1,290 @@
+"""
+Console commands for the Cube.
+
+A line or a whole script is compiled once into Steps, the command name is
+looked up in COMMANDS and its arguments parsed into command_msgs. Scripts
+can repeat blocks:
+
+    # read the sensor at two points, 10 times
+    repeat 10
+        move 0 0 10
+        i2c_transfer 1 1 0C 3F
+        sleep 0.2
+        i2c_transfer 9 1 0C 4F
+        move 0 0 20
+    end
+
+run() submits the msgs of consecutive steps back to back, only sleeps and
+transfers too long for one command wait for the replies before them.
+ScriptRun runs a script file on a worker thread instead.
+"""
+import threading
+import time
+from collections import deque
+from pyCubeLib import cube_commands, cube_pb2
 from pyCubeLib.cube_comm import CubeComm
 
+COORDINATE_MODES = {"cartesian": 0, "cylindrical": 1, "spherical": 2}
+
+# a line printed by a script run on a worker thread
+SCRIPT_OUTPUT = "output"
+# error of the script or None, the last event of a run
+SCRIPT_DONE = "done"
+
+
+class Step:
+    """
+    One compiled command. Its msgs are sent pipelined and
+    action(results) turns their (error, reply) tuples into one. A step
+    without msgs is a barrier, action(cube) runs once every reply
+    before it arrived. action may return a text instead of a reply.
+    A transfer longer than the transfer chunk of the cube it runs on is
+    a barrier too, CubeComm splits or refuses it.
+    """
+    __slots__ = ('line', 'text', 'msgs', 'action', 'size')
+
+    def __init__(self, line, text, msgs, action):
+        self.line = line
+        self.text = text
+        self.msgs = msgs
+        self.action = action
+        # bytes of the longest transfer
+        self.size = max(map(_transfer_size, msgs)) if msgs else 0
+
+
+class Repeat:
+    def __init__(self, count, body):
+        self.count = count
+        self.body = body
+
+
+class StepTimings:
+    """
+    Per line count, total and maximum time of the steps of a run. The time
+    of a pipelined step runs from sending its first command to its last
+    reply.
+    """
+    def __init__(self):
+        self.lines = {}
+        self.steps = 0
+        self.elapsed = 0.0
+
+    def add(self, step, seconds):
+        entry = self.lines.get(step.line)
+        if entry is None:
+            entry = self.lines[step.line] = [step.text, 0, 0.0, 0.0]
+        entry[1] += 1
+        entry[2] += seconds
+        entry[3] = max(entry[3], seconds)
+        self.steps += 1
+
+    def summary(self):
+        rate = self.steps / self.elapsed if self.elapsed > 0 else 0.0
+        lines = [f"{self.steps} steps in {self.elapsed:.3f} s, {rate:.1f} steps/s",
+                 " line  count   mean ms    max ms  command"]
+        for line, (text, count, total, worst) in sorted(self.lines.items()):
+            lines.append(f"{line:5} {count:6} {total / count * 1000:9.3f} {worst * 1000:9.3f}  {text}")
+        return "\n".join(lines)
+
+
+def _transfer_size(msg):
+    if msg.inst == cube_pb2.i2c_transfer:
+        return max(msg.i2c.rx_length, msg.i2c.tx_length)
+    if msg.inst == cube_pb2.spi_transfer:
+        return msg.spi.length
+    return 0
+
+
+def _send_transfer(cube, msg):
+    # a transfer msg through CubeComm instead of as one command
+    if msg.inst == cube_pb2.i2c_transfer:
+        return cube.i2c_transfer(msg.i2c.rx_length, msg.i2c.tx_length, msg.i2c.address, msg.i2c.data)
+    # the protocol has no SPI mode, spi_transfer ignores it
+    return cube.spi_transfer(msg.spi.cs, 0, msg.spi.length, msg.spi.data)
+
+
+def _first_error(results):
+    # (error, reply) of the first failing command, else of the last one
+    for error, reply in results:
+        if error or reply.error != 0:
+            return (error, reply)
+    return results[-1]
+
+
+def _parse_hex(text):
+    return list(bytearray.fromhex(text))
+
+
+def _parse_flag(text):
+    return int(text, 0) != 0
+
+
+def _simple(builder):
+    return lambda args: ([builder()], _first_error)
+
+
+def _get_parameter(args):
+    return ([cube_commands.get_parameter(int(args[0]))], _first_error)
+
+
+def _set_parameter(args):
+    return ([cube_commands.set_parameter(int(args[0]), int(args[1]))], _first_error)
+
+
+def _set_coordinate_mode(args):
+    if args[0] not in COORDINATE_MODES:
+        raise ValueError(f"unknown mode {args[0]}")
+    return ([cube_commands.set_coordinate_mode(COORDINATE_MODES[args[0]])], _first_error)
+
+
+def _move(args):
+    return ([cube_commands.move_to(*map(float, args))], _first_error)
+
+
+def _get_gpio(args):
+    return ([cube_commands.get_gpio(int(args[0]))], _first_error)
+
+
+def _set_gpio(args):
+    return ([cube_commands.set_gpio(int(args[0]), _parse_flag(args[1]))], _first_error)
+
+
+def _set_gpio_mode(args):
+    return ([cube_commands.set_gpio_mode(int(args[0]), _parse_flag(args[1]))], _first_error)
+
+
+def _parse_mask(text):
+    mask = int(text, 0)
+    if mask <= 0:
+        raise ValueError("mask has to select a pin")
+    return mask
+
+
+def _get_gpios(args):
+    mask = _parse_mask(args[0])
+
+    def finish(results):
+        error, reply = _first_error(results)
+        if error or reply.error != 0:
+            return (error, reply)
+        state = 0
+        for pin, (_, reply) in zip(cube_commands.mask_pins(mask), results):
+            if reply.payload_gpio:
+                state |= 1 << pin
+        return (None, f"GPIO state: {state:#x}")
+    return (cube_commands.get_gpios(mask), finish)
+
+
+def _set_gpios(args):
+    return (cube_commands.set_gpios(_parse_mask(args[0]), int(args[1], 0)), _first_error)
+
+
+def _set_gpio_modes(args):
+    return (cube_commands.set_gpio_modes(_parse_mask(args[0]), int(args[1], 0)), _first_error)
+
+
+def _i2c_transfer(args):
+    addr = bytearray.fromhex(args[2])[0]
+    return ([cube_commands.i2c_transfer(int(args[0]), int(args[1]), addr, _parse_hex(args[3]))], _first_error)
+
+
+def _spi_transfer(args):
+    return ([cube_commands.spi_transfer(int(args[0]), int(args[1]), int(args[2]), _parse_hex(args[3]))],
+            _first_error)
+
+
+def _sleep(args):
+    seconds = float(args[0])
+
+    def call(cube):
+        time.sleep(seconds)
+        return (None, None)
+    return (None, call)
+
+
+# name: (argument count, parser returning (msgs, action))
+COMMANDS = {
+    "status": (0, _simple(cube_commands.status)),
+    "relative_pos": (0, _simple(cube_commands.relative_pos)),
+    "absolute_pos": (0, _simple(cube_commands.absolute_pos)),
+    "set_zero": (0, _simple(cube_commands.set_zero)),
+    "reset_zero": (0, _simple(cube_commands.reset_zero)),
+    "home": (0, _simple(cube_commands.home)),
+    "get_parameter": (1, _get_parameter),
+    "set_parameter": (2, _set_parameter),
+    "set_coordinate_mode": (1, _set_coordinate_mode),
+    "move": (3, _move),
+    "get_gpio": (1, _get_gpio),
+    "set_gpio": (2, _set_gpio),
+    "set_gpio_mode": (2, _set_gpio_mode),
+    "get_gpios": (1, _get_gpios),
+    "set_gpios": (2, _set_gpios),
+    "set_gpio_modes": (2, _set_gpio_modes),
+    "i2c_transfer": (4, _i2c_transfer),
+    "spi_transfer": (4, _spi_transfer),
+    "sleep": (1, _sleep),
+}
+
+
+def compile_line(text, line=1):
+    """
+    Compile one command into a Step, raises ValueError.
+    """
+    args = text.split()
+    if len(args) == 0 or args[0] not in COMMANDS:
+        raise ValueError("unknown command")
+    count, parser = COMMANDS[args[0]]
+    if len(args) - 1 != count:
+        raise ValueError(f"{args[0]} takes {count} arguments")
+    try:
+        msgs, action = parser(args[1:])
+    except IndexError as err:
+        raise ValueError(str(err)) from None
+    return Step(line, text.strip(), msgs, action)
+
+
+def compile_script(text):
+    """
+    Compile a script into a program, a list of Steps and Repeats.
+    Everything after a # is a comment. Raises ValueError.
+    """
+    program = []
+    blocks = []
+    for line, source in enumerate(text.splitlines(), 1):
+        source = source.split('#', 1)[0].strip()
+        if len(source) == 0:
+            continue
+        args = source.split()
+        if args[0] == "repeat":
+            if len(args) != 2 or not args[1].isdigit():
+                raise ValueError(f"line {line}: repeat takes a count")
+            repeat = Repeat(int(args[1]), [])
+            program.append(repeat)
+            blocks.append(program)
+            program = repeat.body
+        elif args[0] == "end":
+            if len(blocks) == 0:
+                raise ValueError(f"line {line}: end without repeat")
+            program = blocks.pop()
+        else:
+            try:
+                program.append(compile_line(source, line))
+            except ValueError as err:
+                raise ValueError(f"line {line}: {err}") from None
+    if len(blocks) > 0:
+        raise ValueError("repeat without end")
+    return program
+
+
+def _steps(program):
+    for item in program:
+        if isinstance(item, Repeat):
+            for _ in range(item.count):
+                yield from _steps(item.body)
+        else:
+            yield item
+
+
 class CubeInterpret:
     def __init__(self, cube, print_func):
         self.__cube = cube
@@ -10,100 +295,175 @@ class CubeInterpret:
                     "status        set_parameter get_parameter relative_pos\n"\
                     "absolute_pos  set_zero      reset_zero    set_coordinate_mode\n"\
                     "move          home          get_gpio      set_gpio\n"\
-                    "set_gpio_mode i2c_transfer  spi_transfer\n"
+                    "set_gpio_mode i2c_transfer  spi_transfer  get_gpios\n"\
+                    "set_gpios     set_gpio_modes sleep        run FILE\n"
         self.__print(output_str)
 
+    def __barrier(self, step):
+        # True if step runs once every reply before it arrived
+        return step.msgs is None or step.size > self.__cube.transfer_chunk
+
+    def __call(self, step):
+        # runs a barrier step
+        if step.msgs is None:
+            return step.action(self.__cube)
+        return _send_transfer(self.__cube, step.msgs[0])
+
+    def __execute(self, step):
+        # a single step, waits for its replies
+        if self.__barrier(step):
+            return self.__call(step)
+        return step.action(self.__cube.send_batch(step.msgs))
+
+    def __finish(self, step, handles, timings, echo):
+        results = [handle.result() for handle in handles]
+        for msg, result in zip(step.msgs, results):
+            self.__cube.state.record_msg(msg, result)
+        timings.add(step, max(handle.received or handle.sent for handle in handles) - handles[0].sent)
+        return self.__report(step, *step.action(results), echo)
+
+    def __report(self, step, error, reply, echo):
+        if error:
+            return f"line {step.line}: {error}"
+        if isinstance(reply, str):
+            if echo:
+                self.__print(f"{step.line}: {reply}")
+            return None
+        if reply is None:
+            return None
+        if reply.error != 0:
+            return f"line {step.line}: cube error {reply.error}"
+        if echo and reply.get_payload() is not None:
+            self.__print(f"{step.line}: {reply.get_payload()}")
+        return None
+
+    def run(self, program, echo=True, stop=None):
+        """
+        Run a compiled program, stops at the first failing step or once
+        the stop Event is set. Replies with a payload are printed when
+        echo is set. Returns (error, StepTimings).
+        """
+        timings = StepTimings()
+        inflight = deque()
+        error = None
+        start = time.monotonic()
+        for step in _steps(program):
+            if stop is not None and stop.is_set():
+                error = f"stopped before line {step.line}"
+                break
+            if self.__barrier(step):
+                while len(inflight) > 0 and error is None:
+                    error = self.__finish(*inflight.popleft(), timings, echo)
+                if error:
+                    break
+                begin = time.monotonic()
+                result = self.__call(step)
+                timings.add(step, time.monotonic() - begin)
+                error = self.__report(step, *result, echo)
+            else:
+                for msg in step.msgs:
+                    self.__cube.state.invalidate_msg(msg)
+                inflight.append((step, [self.__cube.submit(msg) for msg in step.msgs]))
+                # finish what already arrived, so a failure stops the run early
+                while len(inflight) > 0 and error is None and all(h.done() for h in inflight[0][1]):
+                    error = self.__finish(*inflight.popleft(), timings, echo)
+            if error:
+                break
+        # replies of commands already sent are still collected
+        while len(inflight) > 0:
+            step_error = self.__finish(*inflight.popleft(), timings, echo and error is None)
+            error = error or step_error
+        timings.elapsed = time.monotonic() - start
+        return (error, timings)
+
+    def run_file(self, path, echo=True, stop=None):
+        """
+        Compile and run a script file, prints the step timings.
+        Returns (error, StepTimings).
+        """
+        try:
+            with open(path) as file:
+                program = compile_script(file.read())
+        except (OSError, ValueError) as err:
+            return (str(err), None)
+        error, timings = self.run(program, echo, stop)
+        self.__print(timings.summary())
+        return (error, timings)
+
     def interpret_command(self, input_string):
+        """
+        Run one console command, returns (error, reply).
+        """
         input_string = input_string.strip()
-        split = input_string.split(' ', 1)
-        cmd = split[0]
-        if cmd == "help":
+        split = input_string.split(None, 1)
+        if len(split) == 0:
+            return (None, None)
+        if split[0] == "help":
             self.__print_help()
-            return False, None, None
-        elif cmd == "status":
-            return self.__cube.status()
-        elif cmd == "relative_pos":
-            return self.__cube.relative_pos()
-        elif cmd == "absolute_pos":
-            return self.__cube.absolute_pos()
-        elif cmd == "set_zero":
-            return self.__cube.set_zero()
-        elif cmd == "reset_zero":
-            return self.__cube.reset_zero()
-        elif cmd == "home":
-            return self.__cube.home()
-        elif cmd == "get_parameter":
-            data = split[1]
-            if len(data) == 0:
-                return True, "too few args", None
-            return self.__cube.get_parameter(int(data.strip()))
-
-        elif cmd == "set_parameter":
-            data = split[1]
-            data = data.split()
-            if (len(data) != 2):
-                return True, "too few args", None
-            return self.__cube.set_parameter(int(data[0]), int(data[1]))
-
-        elif cmd == "set_coordinate_mode":
-            data = split[1]
-            data = data.strip()
-            if (data == "cartesian"):
-                return self.__cube.set_coordinate_mode(0)
-            elif (data == "cylindrical"):
-                return self.__cube.set_coordinate_mode(1)
-            elif (data == "spherical"):
-                return self.__cube.set_coordinate_mode(2)
-            return True, "unknown mode", None
-
-        elif cmd == "move":
-            data = split[1]
-            data = data.split()
-            if (len(data) != 3):
-                return True, "too few args", None
-            return self.__cube.move_to(float(data[0]), float(data[1]), float(data[2]))
-
-        elif cmd == "get_gpio":
-            data = split[1]
-            if len(data) == 0:
-                return True, "too few args", None
-            return self.__cube.get_gpio(int(data))
-
-        elif cmd == "set_gpio":
-            data = split[1]
-            data = data.split()
-            if len(data) != 2:
-                return True, "too few args", None
-            return self.__cube.set_gpio(int(data[0]), bool(data[1]))
-
-        elif cmd == "set_gpio_mode":
-            data = split[1]
-            data = data.split()
-            if len(data) != 2:
-                return True, "too few args", None
-            return self.__cube.set_gpio_mode(int(data[0]), bool(data[1]))
-
-        elif cmd == "i2c_transfer":
-            data = split[1]
-            data = data.split()
-            if len(data) != 4:
-                return True, "too few args", None
-            rx_len = int(data[0])
-            tx_len = int(data[1])
-            addr = bytearray.fromhex(data[2])[0]
-            byte_data = list(bytearray.fromhex(data[3]))
-            return self.__cube.i2c_transfer(rx_len, tx_len, addr, byte_data)
-
-        elif cmd == "spi_transfer":
-            data = split[1]
-            data = data.split()
-            if len(data) != 4:
-                return True, "too few args", None
-            cs = int(data[0])
-            mode = int(data[1])
-            length = int(data[2])
-            byte_data = list(bytearray.fromhex(data[3]))
-            return self.__cube.spi_transfer(cs, mode, length, byte_data)
-
-
-        return True, "unknown command", None
\ No newline at end of file
+            return (None, None)
+        if split[0] == "run":
+            if len(split) != 2:
+                return ("run takes a file", None)
+            return (self.run_file(split[1].strip())[0], None)
+        try:
+            step = compile_line(input_string)
+        except ValueError as err:
+            return (str(err), None)
+        error, reply = self.__execute(step)
+        if isinstance(reply, str):
+            self.__print(reply)
+            return (error, None)
+        return (error, reply)
+
+
+class ScriptRun:
+    """
+    Script file run on a worker thread, so a GUI stays responsive during
+    its sleeps. What it prints is queued as (kind, value) events like the
+    ones of GridScan and drained by poll().
+    """
+    def __init__(self, cube, path, echo=True):
+        self.path = path
+        self.echo = echo
+        self.__events = deque()
+        self.__interpreter = CubeInterpret(cube, lambda text: self.__events.append((SCRIPT_OUTPUT, text)))
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def run(self):
+        """
+        Run the script on the calling thread.
+        """
+        error = "script failed"
+        try:
+            error = self.__interpreter.run_file(self.path, self.echo, self.__stop)[0]
+        except Exception as err:
+            error = f"script failed: {err}"
+        finally:
+            self.__events.append((SCRIPT_DONE, error))
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.run, name="cube-script", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop before the next step.
+        """
+        self.__stop.set()
+
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def join(self, timeout=None):
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def poll(self):
+        """
+        Events since the last poll, oldest first.
+        """
+        events = []
+        while len(self.__events) > 0:
+            events.append(self.__events.popleft())
+        return events
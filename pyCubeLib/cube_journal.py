@@ -0,0 +1,104 @@
+"""
+Binary journal of the traffic of a CubeComm.
+
+The file starts with JOURNAL_MAGIC followed by records of a RECORD header
+(kind, monotonic time in ns, length) and length bytes. Outgoing records
+hold the bytes of one write, incoming records one read from the port as
+received, garbage included. Every opening of a journal starts a session
+with a record holding the wall clock time in ns. Records are only ever
+appended, a truncated last record is ignored when reading.
+"""
+import struct
+import threading
+import time
+
+JOURNAL_MAGIC = b'CUBEJNL1'
+RECORD = struct.Struct('<BqI')
+
+RECORD_SESSION = 0
+RECORD_OUT = 1
+RECORD_IN = 2
+
+# the file is flushed by the first write this long after the last flush,
+# in seconds, or once this many bytes were written since
+FLUSH_INTERVAL = 0.5
+FLUSH_BYTES = 64 * 1024
+
+
+class CubeJournal:
+    """
+    Append only writer, shared by the writing and the reading side of
+    a CubeComm. Writes are flushed every FLUSH_INTERVAL or FLUSH_BYTES,
+    so a crash loses at most the records since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, 'ab')
+        if self.__file.tell() == 0:
+            self.__file.write(JOURNAL_MAGIC)
+        self.__lock = threading.Lock()
+        self.records = 0
+        self.__unflushed = 0
+        self.__flushed = time.monotonic_ns()
+        self.write(RECORD_SESSION, struct.pack('<q', time.time_ns()))
+        self.flush()
+
+    def write(self, kind, data):
+        now = time.monotonic_ns()
+        header = RECORD.pack(kind, now, len(data))
+        with self.__lock:
+            if self.__file.closed:
+                # closed by another thread while the port was in use
+                return
+            self.__file.write(header)
+            self.__file.write(data)
+            self.records += 1
+            self.__unflushed += len(header) + len(data)
+            if self.__unflushed >= FLUSH_BYTES or now - self.__flushed >= FLUSH_INTERVAL * 1e9:
+                self.__flush(now)
+
+    def __flush(self, now):
+        self.__file.flush()
+        self.__unflushed = 0
+        self.__flushed = now
+
+    def flush(self):
+        with self.__lock:
+            if not self.__file.closed:
+                self.__flush(time.monotonic_ns())
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+def read_journal(path):
+    """
+    Yield (kind, timestamp_ns, data) for every record of a journal.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(JOURNAL_MAGIC)) != JOURNAL_MAGIC:
+            raise ValueError(f"{path} is not a Cube journal")
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, timestamp, length = RECORD.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return
+            yield (kind, timestamp, data)
+
+
+def read_sessions(path):
+    """
+    Records of a journal split into sessions, a list of
+    (wall_time_ns, records) tuples.
+    """
+    sessions = []
+    for kind, timestamp, data in read_journal(path):
+        if kind == RECORD_SESSION:
+            sessions.append((struct.unpack('<q', data)[0], []))
+        elif len(sessions) > 0:
+            sessions[-1][1].append((kind, timestamp, data))
+    return sessions
@@ -0,0 +1,459 @@
+"""
+Visiting order of scan grids.
+
+A raster scan flies back to the start of the row after every row and to
+the start of the layer after every layer. The serpentine (boustrophedon)
+order runs every other row and layer backwards, so consecutive points
+are always neighbours on the grid. The axis order, which axis changes
+fastest, is picked to give the shortest path.
+
+A grid scan can be limited to a boolean mask or a region of interest
+(Box, Sphere, Cylinder or a Union of them). PointPlan scans an explicit
+list of points instead, AdaptivePlan refines a coarse grid where the
+measured field changes.
+"""
+import itertools
+import numpy as np
+
+AXES = "xyz"
+# points this close outside a region of interest are still in it, in mm
+ROI_TOLERANCE = 1e-9
+# points of a list this close to a grid point are on it, in mm
+LATTICE_TOLERANCE = 1e-6
+# largest grid a point list is indexed on, the visualizer allocates all of it
+MAX_GRID_POINTS = 10_000_000
+# point lists without a step up to this long are visited in nearest
+# neighbour order, it takes quadratic time
+NEAREST_NEIGHBOUR_POINTS = 2000
+
+
+def serpentine_order(indices, order=(0, 1, 2), serpentine=True):
+    """
+    Permutation that visits an (N, 3) array of grid indices row by row,
+    order lists the axes from the fastest changing one. With serpentine
+    every other row and layer that has points in it is run backwards, so
+    skipped rows do not cause a flyback.
+    """
+    fast, middle, slow = order
+    i, j, k = indices[:, fast], indices[:, middle], indices[:, slow]
+    if serpentine and len(indices) > 0:
+        layer = np.unique(k, return_inverse=True)[1].ravel()
+        j = np.where(layer % 2 == 1, -j, j)
+        # rows numbered in visiting order
+        span = j.max() - j.min() + 1
+        row = np.unique((k - k.min()) * span + (j - j.min()), return_inverse=True)[1].ravel()
+        i = np.where(row % 2 == 1, -i, i)
+    return np.lexsort((i, j, k))
+
+
+def grid_indices(count, order=(0, 1, 2), serpentine=True):
+    """
+    (N, 3) array of the (i, j, k) grid indices of a count[0] x count[1] x
+    count[2] grid in visiting order.
+    """
+    indices = np.indices(count).reshape(3, -1).T
+    return indices[serpentine_order(indices, order, serpentine)]
+
+
+def grid_positions(start, step, indices):
+    """
+    Exact positions start + index * step of an array of grid indices,
+    nothing is accumulated so there is no drift.
+    """
+    return np.asarray(start, dtype=np.float64) + indices * np.asarray(step, dtype=np.float64)
+
+
+def path_length(positions):
+    """
+    Length of the straight moves through an (N, 3) array of positions.
+    """
+    return float(np.linalg.norm(np.diff(positions, axis=0), axis=1).sum())
+
+
+def shortest_order(indices, positions, serpentine=True):
+    """
+    Axis order for serpentine_order() of an (N, 3) array of grid indices
+    with the shortest path through their positions, x fastest when
+    several are equal.
+    """
+    def length(order):
+        return round(path_length(positions[serpentine_order(indices, order, serpentine)]), 6)
+    return min(itertools.permutations(range(3)), key=length)
+
+
+def best_order(count, step, serpentine=True, select=None):
+    """
+    Axis order with the shortest path, x fastest when several are equal.
+    select(indices) returns which points of the grid are visited, all by
+    default.
+    """
+    indices = np.indices(count).reshape(3, -1).T
+    if select is not None:
+        indices = indices[select(indices)]
+    return shortest_order(indices, grid_positions((0, 0, 0), step, indices), serpentine)
+
+
+def nearest_neighbour_order(positions):
+    """
+    Visiting order of arbitrary points, always going to the closest
+    point not visited yet, starting with the first one.
+    """
+    count = len(positions)
+    order = np.zeros(count, dtype=np.int64)
+    remaining = np.ones(count, dtype=bool)
+    current = 0
+    for visit in range(count):
+        order[visit] = current
+        remaining[current] = False
+        candidates = np.flatnonzero(remaining)
+        if len(candidates) == 0:
+            break
+        distances = ((positions[candidates] - positions[current]) ** 2).sum(axis=1)
+        current = candidates[np.argmin(distances)]
+    return order
+
+
+class Box:
+    def __init__(self, low, high):
+        self.low = np.asarray(low, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+
+    def contains(self, positions):
+        return np.all((positions >= self.low - ROI_TOLERANCE) & (positions <= self.high + ROI_TOLERANCE), axis=1)
+
+
+class Sphere:
+    def __init__(self, center, radius):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.radius = radius
+
+    def contains(self, positions):
+        return np.linalg.norm(positions - self.center, axis=1) <= self.radius + ROI_TOLERANCE
+
+
+class Cylinder:
+    """
+    Cylinder along axis (0, 1 or 2) through center, of the given height
+    centered on it or unbounded without one.
+    """
+    def __init__(self, center, radius, axis=2, height=None):
+        self.center = np.asarray(center, dtype=np.float64)
+        self.radius = radius
+        self.axis = axis
+        self.height = height
+
+    def contains(self, positions):
+        offset = positions - self.center
+        along = offset[:, self.axis].copy()
+        offset[:, self.axis] = 0
+        inside = np.linalg.norm(offset, axis=1) <= self.radius + ROI_TOLERANCE
+        if self.height is not None:
+            inside &= np.abs(along) <= self.height / 2 + ROI_TOLERANCE
+        return inside
+
+
+class Union:
+    def __init__(self, *shapes):
+        self.shapes = shapes
+
+    def contains(self, positions):
+        inside = np.zeros(len(positions), dtype=bool)
+        for shape in self.shapes:
+            inside |= shape.contains(positions)
+        return inside
+
+
+def inscribed_roi(kind, start, step, count):
+    """
+    The "sphere" or "cylinder" (along z) inscribed in the box of a grid,
+    None for "box". Axes with a single point are left out, so a planar
+    grid gets the inscribed circle.
+    """
+    if kind == "box":
+        return None
+    start = np.asarray(start, dtype=np.float64)
+    size = (np.asarray(count) - 1).clip(0) * np.asarray(step, dtype=np.float64)
+    center = start + size / 2
+    extent = np.asarray(count) > 1
+    if kind == "sphere":
+        return Sphere(center, size[extent].min() / 2 if extent.any() else 0.0)
+    if kind == "cylinder":
+        return Cylinder(center, size[:2][extent[:2]].min() / 2 if extent[:2].any() else 0.0, axis=2)
+    raise ValueError(f"unknown region {kind}")
+
+
+def read_points(path):
+    """
+    Points of a point list file, x, y, z separated by commas, one point
+    per line. Everything after a # is a comment.
+    """
+    points = np.loadtxt(path, delimiter=',', comments='#', ndmin=2)
+    if points.shape[1] < 3:
+        raise ValueError(f"{path}: points need x, y and z")
+    return points[:, :3]
+
+
+class ScanPlan:
+    """
+    Points of a grid scan in visiting order, as (N, 3) arrays of grid
+    indices and positions, with the estimated path length in mm. Without
+    an order the shortest one is picked. Only the points set in a boolean
+    mask of shape count and inside a roi shape are visited.
+    """
+    # the points do not depend on the measured data
+    open_ended = False
+
+    def __init__(self, start, step, count, order=None, serpentine=True, mask=None, roi=None):
+        self.start = tuple(start)
+        self.step = tuple(step)
+        self.count = tuple(count)
+        self.serpentine = serpentine
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self.roi = roi
+        select = self.__select if mask is not None or roi is not None else None
+        self.order = tuple(order) if order is not None else best_order(self.count, self.step, serpentine, select)
+        indices = np.indices(self.count).reshape(3, -1).T
+        if select is not None:
+            indices = indices[select(indices)]
+        self.indices = indices[serpentine_order(indices, self.order, serpentine)]
+        self.positions = grid_positions(self.start, self.step, self.indices)
+        self.length = path_length(self.positions)
+
+    def __select(self, indices):
+        keep = np.ones(len(indices), dtype=bool)
+        if self.mask is not None:
+            keep &= self.mask[tuple(indices.T)]
+        if self.roi is not None:
+            keep &= self.roi.contains(grid_positions(self.start, self.step, indices))
+        return keep
+
+    def __len__(self):
+        return len(self.indices)
+
+    def points(self):
+        """
+        Yield (index, position, level) tuples in visiting order, the level
+        of a plan that is not refined is always 0.
+        """
+        for index, position in zip(self.indices.tolist(), self.positions.tolist()):
+            yield (tuple(index), tuple(position), 0)
+
+    def record(self, index, data):
+        """
+        Called with the data of every visited point, None if it was
+        skipped. Only AdaptivePlan uses it.
+        """
+
+    def metadata(self):
+        """
+        Description of the grid saved with the scan data.
+        """
+        return {
+            "steps": list(self.count),
+            "start": list(self.start),
+            "step": list(self.step),
+            "order": "".join(AXES[axis] for axis in self.order),
+            "serpentine": self.serpentine,
+            "points": len(self),
+        }
+
+
+class PointPlan:
+    """
+    Scan of an explicit list of points. The points are indexed on a grid,
+    so the visualizer can rebuild it with NaN where no point was measured.
+    With a step the grid starts at start, the smallest coordinates by
+    default, and every point has to be on it. Without one the distinct
+    coordinates of every axis form the grid. Raises ValueError for points
+    off the grid or a grid larger than MAX_GRID_POINTS.
+
+    The points are visited row by row like a ScanPlan, in the axis order
+    with the shortest path. Short lists without a step, which are mostly
+    scattered points, are visited in nearest neighbour order instead.
+    """
+    open_ended = False
+
+    def __init__(self, points, step=None, start=None, serpentine=True):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if len(points) == 0:
+            raise ValueError("no points to scan")
+        self.start = None
+        self.step = None
+        self.axes = None
+        if step is not None:
+            indices, self.count = self.__lattice(points, step, start)
+        else:
+            axes = []
+            indices = np.empty(points.shape, dtype=np.int64)
+            for axis in range(3):
+                # rounded so values that only differ by float noise share an index
+                values, indices[:, axis] = np.unique(np.round(points[:, axis], 6), return_inverse=True)
+                axes.append(values)
+            self.axes = axes
+            self.count = tuple(len(values) for values in axes)
+        size = int(np.prod(self.count, dtype=np.float64))
+        if size > MAX_GRID_POINTS:
+            raise ValueError(f"the points span a {'x'.join(map(str, self.count))} grid, more than "
+                             f"{MAX_GRID_POINTS} points, give the step of the grid they are on")
+        if step is None and len(points) <= NEAREST_NEIGHBOUR_POINTS:
+            self.order = None
+            visit = nearest_neighbour_order(points)
+        else:
+            self.order = shortest_order(indices, points, serpentine)
+            visit = serpentine_order(indices, self.order, serpentine)
+        self.serpentine = serpentine
+        self.indices = indices[visit]
+        self.positions = points[visit]
+        self.length = path_length(self.positions)
+
+    def __lattice(self, points, step, start):
+        # grid indices of points on the grid start + index * step
+        step = np.asarray(step, dtype=np.float64)
+        if np.any(step <= 0):
+            raise ValueError("grid steps have to be positive")
+        start = points.min(axis=0) if start is None else np.asarray(start, dtype=np.float64)
+        indices = np.round((points - start) / step)
+        off = np.abs(start + indices * step - points).max(axis=1) > LATTICE_TOLERANCE
+        off |= np.any(indices < 0, axis=1)
+        if np.any(off):
+            raise ValueError(f"{np.count_nonzero(off)} points are not on the grid, "
+                             f"the first is {tuple(points[np.argmax(off)].tolist())}")
+        self.start = tuple(start.tolist())
+        self.step = tuple(step.tolist())
+        indices = indices.astype(np.int64)
+        return (indices, tuple((indices.max(axis=0) + 1).tolist()))
+
+    def __len__(self):
+        return len(self.indices)
+
+    def points(self):
+        for index, position in zip(self.indices.tolist(), self.positions.tolist()):
+            yield (tuple(index), tuple(position), 0)
+
+    def record(self, index, data):
+        pass
+
+    def metadata(self):
+        if self.axes is None:
+            grid = {"start": list(self.start), "step": list(self.step)}
+        else:
+            grid = {"axes": [values.tolist() for values in self.axes]}
+        if self.order is not None:
+            grid["order"] = "".join(AXES[axis] for axis in self.order)
+            grid["serpentine"] = self.serpentine
+        return {"steps": list(self.count), **grid, "points": len(self)}
+
+
+class AdaptivePlan:
+    """
+    Scan that refines where the field changes. A coarse grid is scanned
+    first, then every cell whose corners differ by more than threshold in
+    any component of the measured data is split in half along each axis,
+    up to depth times or until budget points were visited. The points of
+    a level are visited in serpentine order.
+
+    Indices are on the finest grid, step / 2 ** depth apart, and every
+    point carries the level it was added in. Only the visited points are
+    kept, the finest grid may not be larger than MAX_GRID_POINTS, else
+    ValueError is raised. points() depends on the data passed to record(),
+    so the plan can be scanned only once. Its length is the number of
+    coarse points, how many are added is only known at the end, at most
+    budget points are visited.
+    """
+    open_ended = True
+
+    def __init__(self, start, step, count, threshold, depth=3, budget=None, order=(0, 1, 2)):
+        self.start = tuple(start)
+        self.coarse_step = tuple(step)
+        self.threshold = threshold
+        self.depth = depth
+        self.order = tuple(order)
+        scale = 2 ** depth
+        self.step = tuple(value / scale for value in step)
+        self.count = tuple((n - 1) * scale + 1 if n > 1 else min(n, 1) for n in count)
+        total = int(np.prod(self.count, dtype=np.float64))
+        if total > MAX_GRID_POINTS:
+            raise ValueError(f"refining {depth} times gives a {'x'.join(map(str, self.count))} grid, "
+                             f"more than {MAX_GRID_POINTS} points")
+        self.budget = total if budget is None else min(budget, total)
+        # measured data by fine index, skipped points are only visited
+        self.samples = {}
+        self.visited = set()
+        active = [(0, 1) if n > 1 else (0,) for n in count]
+        # corners of a cell and the points of a halved cell, in cells
+        self.__corners = np.array(list(itertools.product(*active)))
+        self.__halves = np.array(list(itertools.product(*[(0, 1, 2) if len(a) > 1 else (0,) for a in active])))
+        coarse = np.indices(count).reshape(3, -1).T * scale
+        self.__coarse = coarse[serpentine_order(coarse, self.order)]
+        self.__coarse_cells = np.indices([max(n - 1, 1) for n in count]).reshape(3, -1).T * scale
+        self.length = path_length(grid_positions(self.start, self.step, self.__coarse))
+
+    def __len__(self):
+        return min(len(self.__coarse), self.budget)
+
+    def __lookup(self, indices):
+        # measured data at an (N, 3) array of fine indices, NaN where
+        # nothing was measured
+        values = np.full((len(indices), 3), np.nan)
+        if len(self.samples) == 0:
+            return values
+        keys = np.ravel_multi_index(tuple(np.array(list(self.samples)).T), self.count)
+        data = np.array(list(self.samples.values()), dtype=np.float64)
+        order = np.argsort(keys)
+        keys = keys[order]
+        wanted = np.ravel_multi_index(tuple(indices.T), self.count)
+        found = np.searchsorted(keys, wanted).clip(max=len(keys) - 1)
+        hit = keys[found] == wanted
+        values[hit] = data[order[found[hit]]]
+        return values
+
+    def __refine(self, cells, spacing):
+        # points that halve the cells at spacing, given by their lower
+        # corners, whose corners differ by more than threshold, and the
+        # lower corners of the halved cells
+        corners = (cells[:, None, :] + self.__corners[None, :, :] * spacing).reshape(-1, 3)
+        values = self.__lookup(corners).reshape(len(cells), len(self.__corners), 3)
+        # a cell with an unmeasured corner is NaN and never refined
+        variation = (values.max(axis=1) - values.min(axis=1)).max(axis=-1)
+        with np.errstate(invalid='ignore'):
+            cells = cells[variation > self.threshold]
+        half = spacing // 2
+        indices = np.unique((cells[:, None, :] + self.__halves[None, :, :] * half).reshape(-1, 3), axis=0)
+        if len(self.visited) > 0:
+            visited = np.ravel_multi_index(tuple(np.array(list(self.visited)).T), self.count)
+            indices = indices[~np.isin(np.ravel_multi_index(tuple(indices.T), self.count), visited)]
+        halved = (cells[:, None, :] + self.__corners[None, :, :] * half).reshape(-1, 3)
+        return (indices[serpentine_order(indices, self.order)], halved)
+
+    def points(self):
+        visited = 0
+        indices = self.__coarse
+        cells = self.__coarse_cells
+        for level in range(self.depth + 1):
+            if level > 0:
+                indices, cells = self.__refine(cells, 2 ** (self.depth - level + 1))
+            positions = grid_positions(self.start, self.step, indices)
+            for index, position in zip(indices.tolist(), positions.tolist()):
+                if visited == self.budget:
+                    return
+                visited += 1
+                yield (tuple(index), tuple(position), level)
+            if len(indices) == 0:
+                return
+
+    def record(self, index, data):
+        index = tuple(index)
+        self.visited.add(index)
+        if data is not None:
+            self.samples[index] = data
+
+    def metadata(self):
+        return {
+            "steps": list(self.count),
+            "start": list(self.start),
+            "step": list(self.step),
+            "coarse_step": list(self.coarse_step),
+            "depth": self.depth,
+            "threshold": self.threshold,
+            "budget": self.budget,
+        }
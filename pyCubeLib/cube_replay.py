@@ -0,0 +1,209 @@
+"""
+Replay a journal written by CubeComm.start_journal().
+
+The outgoing bytes of one session are written again, at their original
+timing or as fast as possible, to a Cube or to a simulator started for
+the replay. Replies are matched to their commands by id and the latency
+of every command is compared with the journal:
+    python -m pyCubeLib.cube_replay JOURNAL (--port PORT | --sim) [--fast]
+"""
+import argparse
+import threading
+import time
+import numpy as np
+import serial
+from google.protobuf.message import DecodeError
+from pyCubeLib import cube_pb2
+from pyCubeLib.cube_comm import check_frame, decode_reply
+from pyCubeLib.cube_frame import FrameDecoder, unpack_batch, COMMAND_FRAME, REPLY_FRAME, BATCH_COMMAND_FRAME, \
+    frame_kind
+from pyCubeLib.cube_journal import read_sessions, RECORD_IN, RECORD_OUT
+
+
+class CommandIds:
+    """
+    Ids of the commands in a stream of written bytes.
+    """
+    def __init__(self):
+        self.__decoder = FrameDecoder((COMMAND_FRAME, BATCH_COMMAND_FRAME))
+
+    def feed(self, data):
+        ids = []
+        for msg_type, payload in self.__decoder.feed(data):
+            if payload is None:
+                continue
+            try:
+                if frame_kind(msg_type) == BATCH_COMMAND_FRAME:
+                    packets = unpack_batch(payload)[1]
+                else:
+                    packets = [payload]
+                ids += [cube_pb2.command_msg().FromString(bytes(packet)).id for packet in packets]
+            except (ValueError, DecodeError):
+                pass
+        return ids
+
+
+class ReplyIds:
+    """
+    Ids of the replies in a stream of read bytes.
+    """
+    def __init__(self):
+        self.__decoder = FrameDecoder((REPLY_FRAME,))
+
+    def feed(self, data):
+        ids = []
+        for frame in self.__decoder.feed(data):
+            error, packet = check_frame(frame)
+            if error:
+                continue
+            try:
+                ids.append(decode_reply(packet).id)
+            except ValueError:
+                pass
+        return ids
+
+
+def journal_exchanges(records):
+    """
+    {id: [sent_ns, reply_ns]} of a session, from the first time an id was
+    sent and the first reply with it, reply_ns is None if there was none.
+    """
+    commands = CommandIds()
+    replies = ReplyIds()
+    exchanges = {}
+    for kind, timestamp, data in records:
+        if kind == RECORD_OUT:
+            for id in commands.feed(data):
+                exchanges.setdefault(id, [timestamp, None])
+        elif kind == RECORD_IN:
+            for id in replies.feed(data):
+                exchange = exchanges.get(id)
+                if exchange is not None and exchange[1] is None:
+                    exchange[1] = timestamp
+    return exchanges
+
+
+def replay(records, port, fast=False, timeout=1.0):
+    """
+    Write the outgoing records of a session to port, returns the
+    exchanges of the replay like journal_exchanges().
+    """
+    exchanges = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def read():
+        replies = ReplyIds()
+        while not stop.is_set():
+            data = port.read(max(1, port.in_waiting))
+            if len(data) == 0:
+                continue
+            now = time.monotonic_ns()
+            with lock:
+                for id in replies.feed(data):
+                    exchange = exchanges.get(id)
+                    if exchange is not None and exchange[1] is None:
+                        exchange[1] = now
+
+    reader = threading.Thread(target=read, name="cube-replay", daemon=True)
+    reader.start()
+    commands = CommandIds()
+    outgoing = [(timestamp, data) for kind, timestamp, data in records if kind == RECORD_OUT]
+    start = time.monotonic_ns()
+    for timestamp, data in outgoing:
+        if not fast:
+            delay = (timestamp - outgoing[0][0] - (time.monotonic_ns() - start)) / 1e9
+            if delay > 0:
+                time.sleep(delay)
+        ids = commands.feed(data)
+        now = time.monotonic_ns()
+        with lock:
+            for id in ids:
+                exchanges.setdefault(id, [now, None])
+        port.write(data)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with lock:
+            if all(reply is not None for _, reply in exchanges.values()):
+                break
+        time.sleep(0.01)
+    stop.set()
+    reader.join()
+    return exchanges
+
+
+def latencies(exchanges):
+    # ms by id for the answered commands
+    return {id: (reply - sent) / 1e6 for id, (sent, reply) in exchanges.items() if reply is not None}
+
+
+def compare(original, replayed):
+    """
+    Summary of the latency deltas between two sets of exchanges.
+    """
+    before = latencies(original)
+    after = latencies(replayed)
+    both = sorted(set(before) & set(after))
+    report = {
+        "commands": len(original),
+        "answered": len(before),
+        "replayed": len(replayed),
+        "replay_answered": len(after),
+        "lost": len(set(before) - set(after)),
+    }
+    if len(both) == 0:
+        return report
+    before = np.array([before[id] for id in both])
+    after = np.array([after[id] for id in both])
+    delta = after - before
+    for name, values in (("original", before), ("replay", after), ("delta", delta)):
+        report[f"{name}_mean_ms"] = float(values.mean())
+        report[f"{name}_p50_ms"] = float(np.percentile(values, 50))
+        report[f"{name}_p95_ms"] = float(np.percentile(values, 95))
+    worst = np.argsort(np.abs(delta))[::-1][:5]
+    report["largest_deltas"] = {int(both[i]): round(float(delta[i]), 3) for i in worst}
+    return report
+
+
+def main(args):
+    sessions = read_sessions(args.journal)
+    if len(sessions) == 0:
+        print(f"No sessions in {args.journal}")
+        return
+    wall, records = sessions[args.session]
+    print(f"Session from {time.ctime(wall / 1e9)}, {len(records)} records")
+    server = None
+    path = args.port
+    if args.sim:
+        # imported here, the simulator needs a pty
+        from pyCubeLib.cube_sim import CubeSimulator, PtyCubeServer
+        server = PtyCubeServer(CubeSimulator(speed=args.speed), baudrate=args.baud)
+        path = server.start()
+    port = serial.Serial(path, args.baud or 115200, timeout=0.05)
+    try:
+        replayed = replay(records, port, fast=args.fast, timeout=args.timeout)
+    finally:
+        port.close()
+        if server is not None:
+            server.stop()
+    for key, value in compare(journal_exchanges(records), replayed).items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a Cube journal and compare latencies.")
+    parser.add_argument('journal', help="Journal written by CubeComm.start_journal().")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--port', help="Serial port of the Cube to replay against.")
+    target.add_argument('--sim', action='store_true', help="Replay against a simulator.")
+    parser.add_argument('--baud', type=int, default=115200,
+           help="Baud rate of the port, the simulator is throttled to it unless it is 0.")
+    parser.add_argument('--speed', type=float, default=0.0,
+           help="Move speed of the simulator in mm/s, 0 for instant moves.")
+    parser.add_argument('--session', type=int, default=-1, help="Index of the session, the last by default.")
+    parser.add_argument('--fast', action='store_true', help="Write as fast as possible instead of original timing.")
+    parser.add_argument('--timeout', type=float, default=1.0,
+           help="Seconds to wait for outstanding replies after the last write.")
+    main(parser.parse_args())
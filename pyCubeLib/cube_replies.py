@@ -0,0 +1,157 @@
+import numpy as np
+from pyCubeLib.cube_comm import Reply
+
+PAYLOAD_NONE = 0
+PAYLOAD_GPIO = 1
+PAYLOAD_PARAMETER = 2
+PAYLOAD_DATA = 3
+
+
+class ReplyBatch:
+    """
+    Columnar store of many replies.
+
+    ids, error codes, modes, positions and payload values are kept in
+    contiguous NumPy arrays, data payloads in one shared buffer indexed
+    by offsets. Indexing returns a Reply, the array properties allow
+    vectorized analysis of whole sessions and scans.
+    """
+    def __init__(self, capacity=1024):
+        capacity = max(1, capacity)
+        self.__size = 0
+        self.__ids = np.zeros(capacity, dtype=np.uint32)
+        self.__errors = np.zeros(capacity, dtype=np.uint32)
+        self.__modes = np.zeros(capacity, dtype=np.int8)
+        # positions are float32 on the wire
+        self.__positions = np.zeros((capacity, 3), dtype=np.float32)
+        self.__kinds = np.zeros(capacity, dtype=np.uint8)
+        # gpio state, parameter value or the length field of a data payload
+        self.__values = np.zeros(capacity, dtype=np.uint32)
+        self.__offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.__data = bytearray()
+
+    @classmethod
+    def from_replies(cls, replies):
+        replies = list(replies)
+        batch = cls(len(replies))
+        batch.extend(replies)
+        return batch
+
+    def __len__(self):
+        return self.__size
+
+    def __resized(self, array, length, used):
+        new = np.zeros((length,) + array.shape[1:], dtype=array.dtype)
+        new[:used] = array[:used]
+        return new
+
+    def __grow(self, needed):
+        capacity = len(self.__ids)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2)
+        size = self.__size
+        self.__ids = self.__resized(self.__ids, capacity, size)
+        self.__errors = self.__resized(self.__errors, capacity, size)
+        self.__modes = self.__resized(self.__modes, capacity, size)
+        self.__positions = self.__resized(self.__positions, capacity, size)
+        self.__kinds = self.__resized(self.__kinds, capacity, size)
+        self.__values = self.__resized(self.__values, capacity, size)
+        self.__offsets = self.__resized(self.__offsets, capacity + 1, size + 1)
+
+    def append(self, reply):
+        index = self.__size
+        self.__grow(index + 1)
+        self.__ids[index] = reply.id
+        self.__errors[index] = reply.error
+        self.__modes[index] = reply.mode
+        self.__positions[index] = reply.position
+        if reply.payload_gpio is not None:
+            self.__kinds[index] = PAYLOAD_GPIO
+            self.__values[index] = reply.payload_gpio
+        elif reply.payload_parameter is not None:
+            self.__kinds[index] = PAYLOAD_PARAMETER
+            self.__values[index] = reply.payload_parameter
+        elif reply.has_data():
+            length, data = reply.payload_data
+            self.__kinds[index] = PAYLOAD_DATA
+            self.__values[index] = length
+            self.__data += data
+        else:
+            self.__kinds[index] = PAYLOAD_NONE
+            self.__values[index] = 0
+        self.__offsets[index + 1] = len(self.__data)
+        self.__size = index + 1
+
+    def extend(self, replies):
+        for reply in replies:
+            self.append(reply)
+
+    def data(self, index):
+        """
+        Data payload bytes of one reply, empty if it has none.
+        """
+        index = range(self.__size)[index]
+        return bytes(self.__data[self.__offsets[index]:self.__offsets[index + 1]])
+
+    def __getitem__(self, index):
+        index = range(self.__size)[index]
+        position = tuple(float(v) for v in self.__positions[index])
+        reply = Reply(int(self.__ids[index]), int(self.__errors[index]),
+                      int(self.__modes[index]), position)
+        kind = self.__kinds[index]
+        if kind == PAYLOAD_GPIO:
+            reply.payload_gpio = bool(self.__values[index])
+        elif kind == PAYLOAD_PARAMETER:
+            reply.payload_parameter = int(self.__values[index])
+        elif kind == PAYLOAD_DATA:
+            reply.payload_data = (int(self.__values[index]), self.data(index))
+        return reply
+
+    def __iter__(self):
+        for index in range(self.__size):
+            yield self[index]
+
+    @property
+    def ids(self):
+        return self.__ids[:self.__size]
+
+    @property
+    def errors(self):
+        return self.__errors[:self.__size]
+
+    @property
+    def modes(self):
+        return self.__modes[:self.__size]
+
+    @property
+    def positions(self):
+        return self.__positions[:self.__size]
+
+    @property
+    def payload_kinds(self):
+        return self.__kinds[:self.__size]
+
+    @property
+    def payload_values(self):
+        return self.__values[:self.__size]
+
+    @property
+    def data_offsets(self):
+        return self.__offsets[:self.__size + 1]
+
+    @property
+    def data_bytes(self):
+        """
+        Copy of the shared data buffer, slice it with data_offsets.
+        """
+        return bytes(self.__data)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the stored replies, without spare capacity.
+        """
+        columns = (self.ids, self.errors, self.modes, self.positions,
+                   self.payload_kinds, self.payload_values, self.data_offsets)
+        return sum(column.nbytes for column in columns) + len(self.__data)
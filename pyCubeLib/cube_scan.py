@@ -0,0 +1,131 @@
+"""
+Automated measuring of a grid of points.
+
+GridScan moves the Cube to every point of a plan from cube_plan, measures
+it with a measure function and writes the samples to a CSV file. The file
+starts with the date, the plan metadata and TABLE_HEADER. Every sample is
+tagged with its grid index, so loaders do not depend on the visiting
+order, and with the refinement level of an AdaptivePlan (0 otherwise).
+It runs on a worker thread and reports to the GUI through events,
+(kind, value) tuples appended to a deque. Appending and popping are
+atomic, so the GUI drains them once per frame without locking.
+"""
+import threading
+from collections import deque
+from datetime import datetime
+
+TABLE_HEADER = "x_pos, y_pos, z_pos, x_val, y_val, z_val, i, j, k, level\n"
+# measurements of one point tried before it is skipped
+MEASURE_ATTEMPTS = 3
+
+# (done, position, data), data is None for a skipped point
+SCAN_POINT = "point"
+# text of a failed measurement or move
+SCAN_ERROR = "error"
+# (done, outcome), the last event of a scan, outcome is "finished",
+# "stopped" or "failed"
+SCAN_DONE = "done"
+
+
+class GridScan:
+    """
+    Scan of the points of a ScanPlan, PointPlan or AdaptivePlan in its order. A point that can not
+    be measured is skipped and the scan goes on with the next one.
+    """
+    def __init__(self, cube, measure_func, plan, path):
+        self.cube = cube
+        self.measure_func = measure_func
+        self.plan = plan
+        self.path = path
+        # None for an open ended plan, its points depend on the data
+        self.total = None if plan.open_ended else len(plan)
+        self.done = 0
+        self.__events = deque()
+        self.__stop = threading.Event()
+        # cleared while paused
+        self.__resume = threading.Event()
+        self.__resume.set()
+        self.__thread = None
+
+    def __measure(self, position):
+        error, _ = self.cube.move_to(*position)
+        if error:
+            return (f"Move to {position} failed: {error}", None)
+        for _ in range(MEASURE_ATTEMPTS):
+            error, data = self.measure_func(self.cube)
+            if not error:
+                return (None, data)
+        return (f"Skipped {position}: {error}", None)
+
+    def run(self):
+        """
+        Run the scan on the calling thread, returns once it is done or
+        stopped.
+        """
+        outcome = "failed"
+        try:
+            with open(self.path, "w") as save_file:
+                save_file.writelines([datetime.now().isoformat(sep="-") + "\n",
+                                      repr(self.plan.metadata()) + "\n", TABLE_HEADER])
+                for index, position, level in self.plan.points():
+                    self.__resume.wait()
+                    if self.__stop.is_set():
+                        break
+                    error, data = self.__measure(position)
+                    self.plan.record(index, data)
+                    if error:
+                        self.__events.append((SCAN_ERROR, error))
+                    else:
+                        save_file.write(f"{position[0]}, {position[1]}, {position[2]}, {data[0]}, {data[1]}, {data[2]}, "
+                                        f"{index[0]}, {index[1]}, {index[2]}, {level}\n")
+                    self.done += 1
+                    self.__events.append((SCAN_POINT, (self.done, position, data)))
+            outcome = "stopped" if self.__stop.is_set() else "finished"
+        except Exception as err:
+            # saving, a raising measure_func or a dropped port
+            self.__events.append((SCAN_ERROR, f"Scan failed: {err}"))
+        finally:
+            # the GUI waits for it
+            self.__events.append((SCAN_DONE, (self.done, outcome)))
+
+    def start(self):
+        """
+        Run the scan on a worker thread.
+        """
+        self.__thread = threading.Thread(target=self.run, name="cube-scan", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop after the point being measured, also when paused.
+        """
+        self.__stop.set()
+        self.__resume.set()
+
+    def pause(self):
+        """
+        Pause before the next point.
+        """
+        self.__resume.clear()
+
+    def resume(self):
+        self.__resume.set()
+
+    def paused(self):
+        return not self.__resume.is_set()
+
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def join(self, timeout=None):
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def poll(self):
+        """
+        Events since the last poll, oldest first.
+        """
+        events = []
+        while len(self.__events) > 0:
+            events.append(self.__events.popleft())
+        return events
@@ -0,0 +1,427 @@
+"""
+Cube device simulator.
+
+CubeSimulator models the firmware: coordinate state, zero offset, GPIO,
+parameters and an I2C bus with an emulated MLX90393 and EEPROM. PtyCubeServer
+serves it on a pseudo-terminal with the same framing as the real Cube,
+so CubeComm, the console and the GUI can connect to it like to a serial
+port. Run it standalone with:
+    python -m pyCubeLib.cube_sim [--speed MM_S] [--baud BAUD] [--drop P] ...
+"""
+import argparse
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+from pyCubeLib import cube_pb2
+from pyCubeLib.cube_frame import FrameDecoder, encode_frame, unpack_batch, COMMAND_FRAME, REPLY_FRAME, \
+    BATCH_COMMAND_FRAME, BATCH_ABORT_ON_ERROR, CRC_FLAG, CRC_LENGTH, EXTENDED_FLAG, FRAME_MAX_PAYLOAD, frame_kind
+from pyCubeLib.cube_commands import TRANSFER_CHUNK
+
+# error codes reported by the simulator in status_msg.error_id
+ERROR_NONE = 0
+ERROR_OUT_OF_RANGE = 1
+ERROR_INVALID = 2
+ERROR_I2C_NACK = 3
+
+DEFAULT_LATENCY = 0.0005
+DEFAULT_SPEED = 50.0
+
+MLX90393_ADDRESS = 0x0C
+EEPROM_ADDRESS = 0x50
+
+# replies kept for commands sent again with the same id
+REPLY_CACHE_SIZE = 16
+
+
+def to_cartesian(mode, a, b, c):
+    """
+    Convert a, b, c in the given mode to x, y, z. Angles are in degrees,
+    cylindrical is (r, phi, z), spherical is (r, theta, phi).
+    """
+    if mode == cube_pb2.cylindrical:
+        phi = math.radians(b)
+        return (a * math.cos(phi), a * math.sin(phi), c)
+    if mode == cube_pb2.spherical:
+        theta = math.radians(b)
+        phi = math.radians(c)
+        return (a * math.sin(theta) * math.cos(phi),
+                a * math.sin(theta) * math.sin(phi),
+                a * math.cos(theta))
+    return (a, b, c)
+
+
+def from_cartesian(mode, x, y, z):
+    """
+    Convert x, y, z to the given mode, inverse of to_cartesian.
+    """
+    if mode == cube_pb2.cylindrical:
+        return (math.hypot(x, y), math.degrees(math.atan2(y, x)), z)
+    if mode == cube_pb2.spherical:
+        r = math.sqrt(x * x + y * y + z * z)
+        theta = math.degrees(math.acos(z / r)) if r > 0 else 0.0
+        return (r, theta, math.degrees(math.atan2(y, x)))
+    return (x, y, z)
+
+
+def dipole_field(position, center=(0.0, 0.0, -20.0), moment=(0.0, 0.0, 1.0e5)):
+    """
+    Field of a magnetic dipole in uT, position and center in mm.
+    The moment is scaled so the field is a few hundred uT at 30 mm.
+    """
+    r = [p - q for p, q in zip(position, center)]
+    dist = math.sqrt(sum(v * v for v in r))
+    if dist < 1.0:
+        dist = 1.0
+    dot = sum(m * v for m, v in zip(moment, r))
+    return tuple((3 * v * dot / dist ** 2 - m) / dist ** 3 * 1000 for v, m in zip(r, moment))
+
+
+class SimulatedMLX90393:
+    """
+    MLX90393 in single measurement mode, answering the commands
+    used by MLX90393_interface.py with a synthetic field.
+    """
+    STATUS_ERROR = 0x10
+    STATUS_SM_MODE = 0x20
+
+    def __init__(self, field_func=dipole_field, lsb_xy=0.3, lsb_z=0.484):
+        self.field_func = field_func
+        self.lsb_xy = lsb_xy
+        self.lsb_z = lsb_z
+        self.registers = [0] * 64
+        self.__measured = None
+
+    def __raw(self, value, lsb):
+        return max(0, min(0xFFFF, int(round(value / lsb)) + 0x8000))
+
+    def transfer(self, position, tx, rx_len):
+        """
+        Handle one I2C transfer, returns the rx_len bytes read back.
+        """
+        if len(tx) == 0:
+            return bytes(rx_len)
+        command = tx[0] & 0xF0
+        status = 0
+        data = b''
+        if command == 0x30:
+            bx, by, bz = self.field_func(position)
+            self.__measured = (0x8000, self.__raw(bx, self.lsb_xy),
+                               self.__raw(by, self.lsb_xy), self.__raw(bz, self.lsb_z))
+            status = self.STATUS_SM_MODE
+        elif command == 0x40:
+            if self.__measured is None:
+                status = self.STATUS_ERROR
+            else:
+                for value in self.__measured:
+                    data += value.to_bytes(2, 'big')
+                self.__measured = None
+        elif command == 0x50 and len(tx) >= 2:
+            data = self.registers[(tx[1] >> 2) & 0x3F].to_bytes(2, 'big')
+        elif command == 0x60 and len(tx) >= 4:
+            self.registers[(tx[3] >> 2) & 0x3F] = (tx[1] << 8) | tx[2]
+        elif command not in (0x80, 0xD0, 0xF0):
+            status = self.STATUS_ERROR
+        reply = bytes([status]) + data
+        return (reply + bytes(rx_len))[:rx_len]
+
+
+class SimulatedEEPROM:
+    """
+    24LC256 style I2C EEPROM with a two byte address. Reads and writes
+    continue from where the last one stopped.
+    """
+    def __init__(self, size=32768):
+        self.memory = bytearray(size)
+        self.__pointer = 0
+
+    def transfer(self, position, tx, rx_len):
+        if len(tx) >= 2:
+            self.__pointer = ((tx[0] << 8) | tx[1]) % len(self.memory)
+            for value in tx[2:]:
+                self.memory[self.__pointer] = value
+                self.__pointer = (self.__pointer + 1) % len(self.memory)
+        data = bytearray()
+        for _ in range(rx_len):
+            data.append(self.memory[self.__pointer])
+            self.__pointer = (self.__pointer + 1) % len(self.memory)
+        return bytes(data)
+
+
+class CubeSimulator:
+    """
+    Model of the Cube firmware. handle() executes one command_msg and
+    returns the reply_msg, duration() says how long the real device
+    would take, so servers can reproduce the timing.
+    """
+    def __init__(self, latency=None, speed=DEFAULT_SPEED, limits=None, max_transfer=TRANSFER_CHUNK):
+        self.latency = dict(latency) if latency is not None else {}
+        self.speed = speed
+        self.limits = limits
+        # longest SPI or I2C transfer the firmware buffers
+        self.max_transfer = max_transfer
+        self.mode = cube_pb2.cartesian
+        self.position = (0.0, 0.0, 0.0)
+        self.zero = (0.0, 0.0, 0.0)
+        self.parameters = {}
+        self.gpio_modes = {}
+        self.gpio_values = {}
+        self.i2c_devices = {MLX90393_ADDRESS: SimulatedMLX90393(), EEPROM_ADDRESS: SimulatedEEPROM()}
+        self.__last_move = 0.0
+        # serialized command -> reply of the last few commands
+        self.__replies = {}
+
+    def __in_limits(self, position):
+        if self.limits is None:
+            return True
+        return all(low <= p <= high for p, (low, high) in zip(position, self.limits))
+
+    def __move(self, target):
+        if not self.__in_limits(target):
+            self.__last_move = 0.0
+            return ERROR_OUT_OF_RANGE
+        self.__last_move = math.dist(self.position, target)
+        self.position = target
+        return ERROR_NONE
+
+    def relative(self):
+        return tuple(p - z for p, z in zip(self.position, self.zero))
+
+    def duration(self, cmd):
+        """
+        Time in seconds the last handled command takes on the device.
+        """
+        duration = self.latency.get(cmd.inst, DEFAULT_LATENCY)
+        if cmd.inst in (cube_pb2.move_to, cube_pb2.home) and self.speed > 0:
+            duration += self.__last_move / self.speed
+        return duration
+
+    def handle(self, cmd):
+        """
+        Execute cmd, a retried command (same id and content as a recent
+        one) is answered from the reply cache without executing it again.
+        """
+        key = cmd.SerializeToString()
+        if cmd.id != 0 and key in self.__replies:
+            self.__last_move = 0.0
+            return self.__replies[key]
+        reply = self.__execute(cmd)
+        if cmd.id != 0:
+            self.__replies[key] = reply
+            if len(self.__replies) > REPLY_CACHE_SIZE:
+                del self.__replies[next(iter(self.__replies))]
+        return reply
+
+    def __execute(self, cmd):
+        reply = cube_pb2.reply_msg()
+        reply.id = cmd.id
+        error = ERROR_NONE
+        report = self.relative()
+        inst = cmd.inst
+        if inst in (cube_pb2.nop, cube_pb2.status_i, cube_pb2.get_rel_pos):
+            pass
+        elif inst == cube_pb2.get_abs_pos:
+            report = self.position
+        elif inst == cube_pb2.move_to:
+            target = to_cartesian(self.mode, cmd.pos.a, cmd.pos.b, cmd.pos.c)
+            error = self.__move(tuple(t + z for t, z in zip(target, self.zero)))
+            report = self.relative()
+        elif inst == cube_pb2.home:
+            error = self.__move((0.0, 0.0, 0.0))
+            report = self.relative()
+        elif inst == cube_pb2.set_zero_pos:
+            self.zero = self.position
+            report = self.relative()
+        elif inst == cube_pb2.reset_zero_pos:
+            self.zero = (0.0, 0.0, 0.0)
+            report = self.relative()
+        elif inst == cube_pb2.set_coordinate_mode:
+            self.mode = cmd.mode
+        elif inst == cube_pb2.i2c_transfer:
+            device = self.i2c_devices.get(cmd.i2c.address)
+            if max(cmd.i2c.rx_length, cmd.i2c.tx_length) > self.max_transfer:
+                error = ERROR_INVALID
+            elif device is None:
+                error = ERROR_I2C_NACK
+            else:
+                tx = cmd.i2c.data[:cmd.i2c.tx_length]
+                reply.data.length = cmd.i2c.rx_length
+                reply.data.data = device.transfer(self.position, tx, cmd.i2c.rx_length)
+        elif inst == cube_pb2.spi_transfer and cmd.spi.length > self.max_transfer:
+            error = ERROR_INVALID
+        elif inst == cube_pb2.spi_transfer:
+            # loopback, MISO tied to MOSI
+            reply.data.length = cmd.spi.length
+            reply.data.data = cmd.spi.data[:cmd.spi.length]
+        elif inst == cube_pb2.set_gpio_mode:
+            self.gpio_modes[cmd.gpio.index] = cmd.gpio.value
+        elif inst == cube_pb2.set_gpio:
+            self.gpio_values[cmd.gpio.index] = cmd.gpio.value
+        elif inst == cube_pb2.get_gpio:
+            reply.gpio_status = self.gpio_values.get(cmd.gpio.index, False)
+        elif inst == cube_pb2.set_parameter:
+            self.parameters[cmd.param.id] = cmd.param.value
+        elif inst == cube_pb2.get_parameter:
+            reply.param_value = self.parameters.get(cmd.param.id, 0)
+        else:
+            error = ERROR_INVALID
+        if inst not in (cube_pb2.move_to, cube_pb2.home):
+            self.__last_move = 0.0
+        reply.stat.error_id = error
+        reply.stat.mode = self.mode
+        a, b, c = from_cartesian(self.mode, *report)
+        reply.stat.pos.a = a
+        reply.stat.pos.b = b
+        reply.stat.pos.c = c
+        return reply
+
+
+class PtyCubeServer:
+    """
+    Serve a CubeSimulator on a pseudo-terminal.
+
+    baudrate throttles both directions like a serial line would (None for
+    no limit). drop, corrupt and garbage are the probabilities of losing
+    a reply, flipping one of its bytes and sending junk before it.
+    """
+    def __init__(self, simulator=None, baudrate=None, drop=0.0, corrupt=0.0,
+                 garbage=0.0, seed=0, realtime=True):
+        self.simulator = simulator if simulator is not None else CubeSimulator()
+        self.baudrate = baudrate
+        self.drop = drop
+        self.corrupt = corrupt
+        self.garbage = garbage
+        self.realtime = realtime
+        self.__random = random.Random(seed)
+        self.__decoder = FrameDecoder(frame_types=(COMMAND_FRAME, BATCH_COMMAND_FRAME))
+        self.__master = None
+        self.__slave = None
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    @property
+    def port_name(self):
+        return os.ttyname(self.__slave)
+
+    def __line_delay(self, count):
+        if self.realtime and self.baudrate:
+            # start bit, 8 data bits and stop bit per byte
+            time.sleep(count * 10 / self.baudrate)
+
+    def __execute(self, cmd):
+        reply = self.simulator.handle(cmd)
+        if self.realtime:
+            time.sleep(self.simulator.duration(cmd))
+        return reply
+
+    def __reply(self, reply, crc):
+        if self.__random.random() < self.drop:
+            return b''
+        payload = reply.SerializeToString()
+        msg_type = REPLY_FRAME | crc
+        if len(payload) > FRAME_MAX_PAYLOAD - CRC_LENGTH:
+            msg_type |= EXTENDED_FLAG
+        frame = bytearray(encode_frame(msg_type, payload))
+        if self.__random.random() < self.corrupt:
+            frame[self.__random.randrange(len(frame))] ^= 1 << self.__random.randrange(8)
+        if self.__random.random() < self.garbage:
+            frame[0:0] = bytes(self.__random.randrange(256) for _ in range(self.__random.randrange(1, 8)))
+        return bytes(frame)
+
+    def __serve(self):
+        while not self.__stop.is_set():
+            ready, _, _ = select.select([self.__master], [], [], 0.1)
+            if len(ready) == 0:
+                continue
+            try:
+                data = os.read(self.__master, 512)
+            except OSError:
+                return
+            self.__line_delay(len(data))
+            for msg_type, payload in self.__decoder.feed(data):
+                if payload is None:
+                    # wrong CRC, the host retries
+                    continue
+                # replies use CRC frames when the command did
+                crc = msg_type & CRC_FLAG
+                if frame_kind(msg_type) == BATCH_COMMAND_FRAME:
+                    try:
+                        flags, packets = unpack_batch(payload)
+                    except ValueError:
+                        continue
+                else:
+                    flags, packets = 0, [payload]
+                for packet in packets:
+                    try:
+                        cmd = cube_pb2.command_msg().FromString(packet)
+                    except Exception:
+                        continue
+                    reply = self.__execute(cmd)
+                    out = self.__reply(reply, crc)
+                    self.__line_delay(len(out))
+                    os.write(self.__master, out)
+                    if reply.stat.error_id != ERROR_NONE and flags & BATCH_ABORT_ON_ERROR:
+                        break
+
+    def start(self):
+        """
+        Open the pty and start serving, returns the port path for clients.
+        """
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__serve, name="cube-sim", daemon=True)
+        self.__thread.start()
+        return self.port_name
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+        os.close(self.__master)
+        os.close(self.__slave)
+
+
+def main(args):
+    latency = {}
+    for item in args.latency or []:
+        name, value = item.split('=')
+        latency[cube_pb2.instruction.Value(name)] = float(value)
+    simulator = CubeSimulator(latency=latency, speed=args.speed, max_transfer=args.max_transfer)
+    server = PtyCubeServer(simulator, baudrate=args.baud, drop=args.drop,
+                           corrupt=args.corrupt, garbage=args.garbage, seed=args.seed)
+    path = server.start()
+    if args.link:
+        if os.path.islink(args.link):
+            os.unlink(args.link)
+        os.symlink(path, args.link)
+    print(f"Simulated Cube on {path}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    if args.link:
+        os.unlink(args.link)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated Cube on a pseudo-terminal.")
+    parser.add_argument('--speed', type=float, default=DEFAULT_SPEED,
+           help="Move speed in mm/s, 0 for instant moves.")
+    parser.add_argument('--baud', type=int, default=115200,
+           help="Throttle the line to this baud rate, 0 for no limit.")
+    parser.add_argument('--latency', action='append', metavar='INST=SECONDS',
+           help="Processing time of an instruction, e.g. status_i=0.002. Can be repeated.")
+    parser.add_argument('--drop', type=float, default=0.0, help="Probability of dropping a reply.")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="Probability of corrupting a reply.")
+    parser.add_argument('--garbage', type=float, default=0.0, help="Probability of junk before a reply.")
+    parser.add_argument('--max-transfer', type=int, default=TRANSFER_CHUNK,
+           help="Longest SPI or I2C transfer in bytes the firmware accepts.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--link', metavar='PATH', help="Create a symlink to the pty at PATH.")
+    main(parser.parse_args())
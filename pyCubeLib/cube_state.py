@@ -0,0 +1,101 @@
+import math
+import time
+from pyCubeLib import cube_pb2
+
+# instructions after which the position is unknown until the next reply
+MOVE_INSTRUCTIONS = (cube_pb2.move_to, cube_pb2.home)
+# instructions whose reply reports the absolute position, not the relative one
+ABSOLUTE_INSTRUCTIONS = (cube_pb2.get_abs_pos,)
+
+# reported positions are float32, targets closer than this count as reached
+POSITION_TOLERANCE = 1e-4
+
+
+class CubeState:
+    """
+    Host side mirror of the Cube state.
+
+    The status of every reply updates mode, position and error. Values
+    written by set commands and read by get commands are kept per id or
+    pin, a set command drops its entry until the Cube confirms it.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """
+        Forget everything, e.g. when the port changes.
+        """
+        self.mode = None
+        # last reported position, relative and in mode
+        self.position = None
+        self.position_known = False
+        self.error = None
+        self.updated = None
+        self.parameters = {}
+        self.gpio_modes = {}
+        self.gpio_outputs = {}
+
+    def update(self, reply, inst=None):
+        """
+        Take the status of a reply to inst. The position is kept when the
+        reply reports the absolute one or inst is None, a reply that
+        could not be matched to its command.
+        """
+        self.mode = reply.mode
+        if inst is not None and inst not in ABSOLUTE_INSTRUCTIONS:
+            self.position = reply.position
+            self.position_known = True
+        self.error = reply.error
+        self.updated = time.monotonic()
+
+    def at(self, position):
+        """
+        True if the Cube is known to stand at position.
+        """
+        if not self.position_known:
+            return False
+        return all(math.isclose(p, t, rel_tol=1e-6, abs_tol=POSITION_TOLERANCE)
+                   for p, t in zip(self.position, position))
+
+    def invalidate(self, inst, key):
+        if inst == cube_pb2.set_parameter:
+            self.parameters.pop(key, None)
+        elif inst == cube_pb2.set_gpio_mode:
+            self.gpio_modes.pop(key, None)
+        elif inst == cube_pb2.set_gpio:
+            self.gpio_outputs.pop(key, None)
+
+    def record(self, inst, key, value, result):
+        """
+        Remember the value of a finished set or get command.
+        """
+        error, reply = result
+        if error or reply.error != 0:
+            return
+        if inst == cube_pb2.get_parameter:
+            self.parameters[key] = reply.payload_parameter or 0
+        elif inst == cube_pb2.set_parameter:
+            self.parameters[key] = value
+        elif inst == cube_pb2.set_gpio_mode:
+            self.gpio_modes[key] = value
+        elif inst == cube_pb2.set_gpio:
+            self.gpio_outputs[key] = value
+
+    def invalidate_msg(self, msg):
+        self.invalidate(msg.inst, _msg_key(msg)[0])
+
+    def record_msg(self, msg, result):
+        """
+        record() for a command_msg.
+        """
+        self.record(msg.inst, *_msg_key(msg), result)
+
+
+def _msg_key(msg):
+    # (id or pin, value) of a command_msg
+    if msg.inst in (cube_pb2.get_parameter, cube_pb2.set_parameter):
+        return (msg.param.id, msg.param.value)
+    if msg.inst in (cube_pb2.set_gpio_mode, cube_pb2.set_gpio):
+        return (msg.gpio.index, msg.gpio.value)
+    return (None, None)
@@ -0,0 +1,102 @@
+import bisect
+from pyCubeLib import cube_pb2
+
+# upper bounds of the latency histogram buckets in ms, the last one is open
+LATENCY_BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def snapshot(self):
+        buckets = {}
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            if count:
+                buckets[f"<={bound}ms"] = count
+        if self.counts[-1]:
+            buckets[f">{LATENCY_BUCKETS[-1]}ms"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else None,
+            "min_ms": self.min,
+            "max_ms": self.max,
+            "buckets": buckets,
+        }
+
+
+class CommStats:
+    """
+    Counters and per instruction latency histograms of a CubeComm.
+    Latencies are measured from sending the command to the first byte
+    and to the complete frame of its reply.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.commands = 0
+        self.frames = 0
+        self.retries = 0
+        self.dropped_replies = 0
+        # commands answered from the state mirror
+        self.cached = 0
+        self.errors = {}
+        self.first_byte = {}
+        self.complete = {}
+
+    def count_error(self, error):
+        self.errors[error] = self.errors.get(error, 0) + 1
+
+    def add_reply(self, inst, first_byte, complete):
+        if inst not in self.complete:
+            self.first_byte[inst] = LatencyHistogram()
+            self.complete[inst] = LatencyHistogram()
+        self.first_byte[inst].add(first_byte)
+        self.complete[inst].add(complete)
+
+    def snapshot(self):
+        latency = {}
+        for inst, histogram in self.complete.items():
+            latency[cube_pb2.instruction.Name(inst)] = {
+                "first_byte": self.first_byte[inst].snapshot(),
+                "complete": histogram.snapshot(),
+            }
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "commands": self.commands,
+            "frames": self.frames,
+            "retries": self.retries,
+            "dropped_replies": self.dropped_replies,
+            "cached": self.cached,
+            "errors": dict(self.errors),
+            "latency": latency,
+        }
+
+    def summary(self):
+        """
+        Short human readable summary for status displays.
+        """
+        replies = sum(h.count for h in self.complete.values())
+        total = sum(h.total for h in self.complete.values())
+        mean = f"{total / replies:.2f} ms" if replies else "-"
+        return (f"Commands: {self.commands}, errors: {sum(self.errors.values())}\n"
+                f"Bytes out/in: {self.bytes_out}/{self.bytes_in}\n"
+                f"Mean reply time: {mean}")
@@ -1,13 +1,15 @@
 from functools import partial
 from pathlib import Path
-from datetime import datetime
 import dearpygui.dearpygui as dpg
 import serial.tools.list_ports as ports
 import serial
 from pyCubeLib.cube_comm import CubeComm
-from pyCubeLib.cube_interpret import CubeInterpret
+from pyCubeLib.cube_interpret import CubeInterpret, ScriptRun, SCRIPT_OUTPUT, SCRIPT_DONE
+from pyCubeLib.cube_plan import ScanPlan, PointPlan, AdaptivePlan, inscribed_roi, read_points
+from pyCubeLib.cube_scan import GridScan, SCAN_POINT, SCAN_ERROR, SCAN_DONE
 
-TABLE_HEADER = "x_pos, y_pos, z_pos, x_val, y_val, z_val\n"
+# the comm retries lost replies of moves and other idempotent commands
+COMM_RETRIES = 3
 
 class CubeGUI:
     def __init__(self, measure_func = None, init_func = None):
@@ -21,10 +23,17 @@ class CubeGUI:
         self.__error_window = dpg.window(no_close=True, no_collapse=True, label="Error", pos=(240, 240), modal=True, show=False, autosize=True, id="ERROR_WINDOW")
         self.__serial_port = None
         self.__measure_func = measure_func
-        self.__measuring = False
+        # the running GridScan, polled once per frame
+        self.__scan = None
+        # the console script running on a worker thread, polled once per frame
+        self.__script = None
         self.__init_func = init_func
         self.__sensor_initialized = False
         self.__cube = CubeComm(111)
+        self.__cube.enable_stats()
+        self.__cube.set_retries(COMM_RETRIES)
+        # a move to where the Cube already stands costs no round trip
+        self.__cube.set_skip_moves()
         self.__interpreter = CubeInterpret(self.__cube, self.__log_info)
 
 
@@ -61,6 +70,10 @@ class CubeGUI:
         self.__log_sent(in_txt)
         dpg.set_value("CONSOLE_IN", "")
         dpg.focus_item("CONSOLE_IN")
+        split = in_txt.split(None, 1)
+        if len(split) == 2 and split[0] == "run":
+            self.__run_script(split[1].strip())
+            return
         error, reply = self.__interpreter.interpret_command(in_txt)
         if error:
             self.__log_error(error)
@@ -77,6 +90,37 @@ class CubeGUI:
 
 
 
+    def __run_script(self, path):
+        # scripts sleep and wait for moves, so they run off the render thread
+        if self.__script is not None:
+            self.__log_error("A script is already running")
+            return
+        self.__script = ScriptRun(self.__cube, path)
+        self.__script.start()
+
+
+    def __poll_script(self):
+        script = self.__script
+        if script is None:
+            return
+        for kind, value in script.poll():
+            if kind == SCRIPT_OUTPUT:
+                self.__log_info(value)
+            elif kind == SCRIPT_DONE:
+                if value:
+                    self.__log_error(value)
+                else:
+                    self.__log_info(f"Script {script.path} finished")
+                self.__script = None
+
+
+    def __stop_script(self):
+        if self.__script is not None:
+            self.__script.stop()
+            self.__script.join()
+            self.__poll_script()
+
+
     def __update_final_pos(self):
         final_pos_x = dpg.get_value("AUTO_START_X") + dpg.get_value("AUTO_STEP_X") * dpg.get_value("AUTO_COUNT_X")
         final_pos_y = dpg.get_value("AUTO_START_Y") + dpg.get_value("AUTO_STEP_Y") * dpg.get_value("AUTO_COUNT_Y")
@@ -87,6 +131,7 @@ class CubeGUI:
 
 
     def __update_status(self, data):
+        dpg.set_value("STATUS_STATS", self.__cube.stats_summary())
         if data is None:
             return
         pos = data.position
@@ -120,6 +165,10 @@ class CubeGUI:
             self.__show_error("Not connected!")
             return
 
+        if self.__scan is not None:
+            self.__show_error("Already measuring!")
+            return
+
         if (self.__init_func is None or self.__measure_func is None):
             self.__show_error("No init or measure function!")
             return
@@ -129,57 +178,81 @@ class CubeGUI:
             return
 
 
+        start = (dpg.get_value("AUTO_START_X"), dpg.get_value("AUTO_START_Y"), dpg.get_value("AUTO_START_Z"))
+        step = (dpg.get_value("AUTO_STEP_X"), dpg.get_value("AUTO_STEP_Y"), dpg.get_value("AUTO_STEP_Z"))
+        count = (dpg.get_value("AUTO_COUNT_X"), dpg.get_value("AUTO_COUNT_Y"), dpg.get_value("AUTO_COUNT_Z"))
         file_path = Path(dpg.get_value("AUTO_SAVE_FILE"))
-        save_file = open(file_path, "w")
-        date_str = datetime.now().isoformat(sep="-") + "\n"
-        save_file.writelines([date_str, TABLE_HEADER])
-
-        steps_count = dpg.get_value("AUTO_COUNT_X") * dpg.get_value("AUTO_COUNT_Y") * dpg.get_value("AUTO_COUNT_Z")
-        done = 0
-        self.__measuring = True
-
-        current_x = dpg.get_value("AUTO_START_X")
-        current_y = dpg.get_value("AUTO_START_Y")
-        current_z = dpg.get_value("AUTO_START_Z")
-
-        step_x = dpg.get_value("AUTO_STEP_X")
-        step_y = dpg.get_value("AUTO_STEP_Y")
-        step_z = dpg.get_value("AUTO_STEP_Z")
-
-        self.__cube.move_to(current_x, current_y, current_z)
-
-        for z in range(dpg.get_value("AUTO_COUNT_Z")):
-            for y in range(dpg.get_value("AUTO_COUNT_Y")):
-                for x in range(dpg.get_value("AUTO_COUNT_X")):
-                    if not self.__measuring:
-                        break
-                    error, data = self.__measure_func(self.__cube)
-                    if error:
-                        continue
-                    save_file.write(f"{current_x}, {current_y}, {current_z}, {data[0]}, {data[1]}, {data[2]}\n")
-                    #self.__log_info(f"{current_x}, {current_y}, {current_z}, {data[0]}, {data[1]}, {data[2]}")
-                    current_x += step_x
-                    error, data = self.__cube.move_to(current_x, current_y, current_z)
-                    done += 1
-                    dpg.set_value("AUTO_PROGRESS", f"{done}/{steps_count}")
-                if not self.__measuring:
-                    break
-                current_y += step_y
-                current_x = dpg.get_value("AUTO_START_X")
-            if not self.__measuring:
-                break
-            current_x = dpg.get_value("AUTO_START_X")
-            current_y = dpg.get_value("AUTO_START_Y")
-            current_z += step_z
-
-        self.__measuring = False
-
-        save_file.flush()
-        save_file.close()
+        point_file = dpg.get_value("AUTO_POINT_FILE").strip()
+        try:
+            if point_file:
+                plan = PointPlan(read_points(point_file), step=step)
+            elif dpg.get_value("AUTO_DEPTH") > 0:
+                plan = AdaptivePlan(start, step, count, dpg.get_value("AUTO_THRESHOLD"), dpg.get_value("AUTO_DEPTH"),
+                                    dpg.get_value("AUTO_BUDGET"))
+            else:
+                roi = inscribed_roi(dpg.get_value("AUTO_REGION"), start, step, count)
+                plan = ScanPlan(start, step, count, serpentine=dpg.get_value("AUTO_SERPENTINE"), roi=roi)
+        except (OSError, ValueError) as err:
+            self.__show_error(f"Scan plan failed: {err}")
+            return
+        self.__scan = GridScan(self.__cube, self.__measure_func, plan, file_path)
+        self.__scan.start()
+        dpg.set_value("AUTO_PROGRESS", self.__progress(self.__scan, 0))
+        if self.__scan.total is None:
+            points = f"{len(plan)} coarse points, at most {plan.budget} in total,"
+        else:
+            points = f"{self.__scan.total} points"
+        self.__log_info(f"Measuring {points} to {file_path}, path {plan.length:.1f} mm")
 
 
     def __stop_measuring(self):
-        self.__measuring = False
+        if self.__scan is not None:
+            self.__scan.stop()
+
+
+    def __pause_measuring(self):
+        if self.__scan is not None:
+            self.__scan.pause()
+            self.__log_info("Measuring paused")
+
+
+    def __resume_measuring(self):
+        if self.__scan is not None and self.__scan.paused():
+            self.__scan.resume()
+            self.__log_info("Measuring resumed")
+
+
+    def __progress(self, scan, done):
+        if scan.total is None:
+            return f"{done}/<={scan.plan.budget}"
+        return f"{done}/{scan.total}"
+
+
+    def __poll_scan(self):
+        # called every frame, only the latest progress and sample are shown
+        scan = self.__scan
+        if scan is None:
+            return
+        point = None
+        for kind, value in scan.poll():
+            if kind == SCAN_POINT:
+                point = value
+            elif kind == SCAN_ERROR:
+                self.__log_error(value)
+            elif kind == SCAN_DONE:
+                done, outcome = value
+                self.__log_info(f"Measuring {outcome} after {done} points")
+                self.__scan = None
+        if point is not None:
+            done, position, data = point
+            dpg.set_value("AUTO_PROGRESS", self.__progress(scan, done))
+            if data is not None:
+                dpg.set_value("AUTO_LAST_SAMPLE", f"{position}: {data}")
+
+
+    def __reset_stats(self):
+        self.__cube.reset_stats()
+        dpg.set_value("STATUS_STATS", self.__cube.stats_summary())
 
 
     def __update_ports(self):
@@ -200,6 +273,8 @@ class CubeGUI:
         self.__serial_port.flush()
         dpg.set_value("STATUS_CON", "Connected " + port)
         self.__cube.set_serial_port(self.__serial_port)
+        # the console, buttons and automated measuring share the cube
+        self.__cube.start_reader()
         error, ret = self.__cube.status()
         self.__log_sent("status")
         self.__update_status(ret)
@@ -213,11 +288,17 @@ class CubeGUI:
     def __disconnect_serial(self):
         if (self.__serial_port is None):
             self.__show_error("No port to close!")
+        if self.__scan is not None:
+            # the worker would write to the closed port
+            self.__scan.stop()
+            self.__scan.join()
+            self.__poll_scan()
+        self.__stop_script()
+        self.__cube.set_serial_port(None)
         self.__serial_port.flush()
         self.__serial_port.close()
         self.__serial_port = None
         dpg.set_value("STATUS_CON", "Disconnected")
-        self.__cube.set_serial_port(self.__serial_port)
 
 
     def __goto_pos(self):
@@ -316,9 +397,27 @@ class CubeGUI:
             with dpg.group(horizontal=True):
                 dpg.add_button(label="Start measuring", callback=self.__start_measuring)
                 dpg.add_button(label="Stop measuring", callback=self.__stop_measuring)
+                dpg.add_button(label="Pause", callback=self.__pause_measuring)
+                dpg.add_button(label="Resume", callback=self.__resume_measuring)
+                dpg.add_checkbox(label="Serpentine", default_value=True, id="AUTO_SERPENTINE")
+            with dpg.group(horizontal=True):
+                dpg.add_text("Region:")
+                dpg.add_combo(items=["box", "sphere", "cylinder"], default_value="box", width=100, id="AUTO_REGION")
+                dpg.add_text("Point list:")
+                dpg.add_input_text(width=200, hint="x, y, z per line, on the grid of Step", id="AUTO_POINT_FILE")
+            with dpg.group(horizontal=True):
+                # depth 0 scans the full grid, otherwise it is the coarse pass
+                dpg.add_text("Refine depth:")
+                dpg.add_input_int(default_value=0, min_value=0, max_value=6, width=100, id="AUTO_DEPTH")
+                dpg.add_text("Threshold:")
+                dpg.add_input_float(default_value=10, min_value=0, width=100, id="AUTO_THRESHOLD")
+                dpg.add_text("Budget:")
+                dpg.add_input_int(default_value=2000, min_value=1, width=100, id="AUTO_BUDGET")
             with dpg.group(horizontal=True):
                 dpg.add_text("Progress:")
                 dpg.add_text("0/0", id="AUTO_PROGRESS")
+                dpg.add_text("Last sample:")
+                dpg.add_text("", id="AUTO_LAST_SAMPLE")
 
 
     def __setup_console(self):
@@ -356,6 +455,8 @@ class CubeGUI:
             dpg.add_text("Last ack ID:")
             dpg.add_same_line()
             dpg.add_text("0", id="STATUS_ACK_ID")
+            dpg.add_text("", id="STATUS_STATS")
+            dpg.add_button(label="Reset stats", callback=self.__reset_stats)
 
 
     def __setup_control(self):
@@ -394,7 +495,16 @@ class CubeGUI:
         self.__setup_windows()
         dpg.setup_dearpygui(viewport=self.__vp)
         dpg.show_viewport(self.__vp)
-        dpg.start_dearpygui()
+        # rendered by hand, so scan events are drained once per frame
+        while dpg.is_dearpygui_running():
+            self.__poll_scan()
+            self.__poll_script()
+            dpg.render_dearpygui_frame()
+        if self.__scan is not None:
+            self.__scan.stop()
+            self.__scan.join()
+        self.__stop_script()
+        dpg.cleanup_dearpygui()
 
 
 if (__name__ == "__main__"):
@@ -1,5 +1,7 @@
 from pyCubeLib import CubeComm
+from pyCubeLib.cube_interpret import CubeInterpret
 import serial
+import json
 import cmd
 import sys
 
@@ -57,6 +59,47 @@ class CubeConsole(cmd.Cmd):
             return
         print("Moved to:", coord)
 
+    def do_params(self, args):
+        """Read, save or restore parameters.\nSyntax: params get ID [ID ...]\n        params save FILE ID [ID ...]\n        params restore FILE"""
+        split_args = args.split()
+        if len(split_args) < 2 or split_args[0] not in ("get", "save", "restore"):
+            print("!!! Wrong arguments!")
+            return
+        try:
+            if split_args[0] == "get":
+                error, values = self.cube.get_parameters(map(int, split_args[1:]))
+            elif split_args[0] == "save":
+                error, values = self.cube.save_parameters(split_args[1], map(int, split_args[2:]))
+            else:
+                error, values = self.cube.restore_parameters(split_args[1])
+        except (OSError, ValueError, KeyError) as err:
+            print("!!! Parameter file error:", err)
+            return
+        if error:
+            print("!!! Comms error:", error)
+            return
+        if split_args[0] == "restore":
+            print("Changed:", values)
+        else:
+            print(values)
+
+    def do_run(self, args):
+        """Run a script of console commands, see cube_interpret.\nSyntax: run FILE"""
+        if len(args.strip()) == 0:
+            print("!!! Wrong arguments!")
+            return
+        error, _ = CubeInterpret(self.cube, print).run_file(args.strip())
+        if error:
+            print("!!! Script error:", error)
+
+    def do_stats(self, args):
+        """Show communication counters and latencies.\nSyntax: stats [reset]"""
+        if args.strip() == "reset":
+            self.cube.reset_stats()
+            print("Stats reset")
+            return
+        print(json.dumps(self.cube.stats_snapshot(), indent=2))
+
 
 if __name__ == "__main__":
     if (len(sys.argv) < 2):
@@ -71,6 +114,7 @@ if __name__ == "__main__":
     serial_port.flush()
     cube = CubeComm(200)
     cube.set_serial_port(serial_port)
+    cube.enable_stats()
 
     print("Checking cube:")
     error, ret = cube.status()
@@ -2,7 +2,6 @@ import linecache
 import argparse
 import ast
 import numpy as np
-from mayavi import mlab
 from functools import partial
 
 SLICE_VARIANTS = [
@@ -25,11 +24,16 @@ size of the vector. If the second character is omited, the slice is
 a vector field slice. EXAMPLE: "-s xy -s x -s zx"
 """
 
-def split_further(input_array, size):
-    array = []
-    for item in input_array:
-        array.append(np.split(item, size))
-    return np.array(array)
+def place_by_index(data, steps):
+    # samples tagged with their i, j, k grid index can be in any order,
+    # points that were not measured are NaN
+    index = tuple(data[:, 6:9].astype(int).T)
+    fields = []
+    for column in range(3, 6):
+        field = np.full(steps, np.nan)
+        field[index] = data[:, column]
+        fields.append(field)
+    return tuple(fields)
 
 
 def load_data(input_file):
@@ -37,22 +41,21 @@ def load_data(input_file):
     metadata = ast.literal_eval(linecache.getline(input_file, 2))
 
     # load the .csv values
-    x, y, z, u, v, w = np.loadtxt(input_file, delimiter=', ', skiprows=3, unpack=True)
-    
-    # split the data
-    # currently expects that the data and easily splitable in linear way and does not need reordering
-    x_new = np.split(u, metadata['steps'][2])
-    y_new = np.split(v, metadata['steps'][2])
-    z_new = np.split(w, metadata['steps'][2])
-
-    # we need to swap axes to properly rotate the data as the splitting inverts along one axis
-    x_new = np.swapaxes(split_further(x_new, metadata['steps'][1]), 0, 2)
-    y_new = np.swapaxes(split_further(y_new, metadata['steps'][1]), 0, 2)
-    z_new = np.swapaxes(split_further(z_new, metadata['steps'][1]), 0, 2)
-    return x_new, y_new, z_new
+    data = np.loadtxt(input_file, delimiter=',', skiprows=3, ndmin=2)
+    if data.shape[1] > 6:
+        return place_by_index(data, metadata['steps'])
+    # rows are in raster order, x changing fastest, reshape to [x, y, z]
+    steps = metadata['steps']
+    fields = []
+    for column in range(3, 6):
+        fields.append(data[:, column].reshape(steps[2], steps[1], steps[0]).transpose(2, 1, 0))
+    return tuple(fields)
 
 
 def main(args):
+    # mayavi is slow to import and not needed to just load data
+    from mayavi import mlab
+
     # load the data and prepare the Mayavi pipeline sources
     x, y, z = load_data(args["DATAFILE"])
     vec_src = mlab.pipeline.vector_field(x, y, z)